@@ -0,0 +1,166 @@
+"""Per-hangout queue that folds concurrent actions into one transaction.
+
+All of a hangout's game entities are in one entity group, so concurrent
+actions on the same game (e.g. several players selecting at once) would each
+run their own transaction and collide, causing retries.  Instead, actions are
+submitted to the hangout's queue: the first request to arrive becomes the
+queue's leader and applies all the actions pending at that moment (its own
+included) with a single GameEngine.run_actions transaction -- one 'tick'.  The
+result of each action is handed back to the request that submitted it, and
+leadership passes to the next waiting request, if any, so no request has to
+process more than one tick on behalf of others.
+
+If a tick's transaction fails, its actions are applied again one at a time,
+so that one failing action doesn't fail the others submitted with it.  If a
+waiting request hears nothing from the leader for ACTION_QUEUE_WAIT_SECONDS
+while its actions are still queued, it leads a tick itself.
+
+The queue coordinates the requests handled by one instance; requests for the
+same hangout on other instances still rely on the transaction retries.
+"""
+
+import logging
+import sys
+import threading
+
+import config
+import states
+
+
+class _PendingAction(object):
+
+  def __init__(self, action, kwargs, wake):
+    self.action = action
+    self.kwargs = kwargs
+    self.lead = False  # whether this action's request should run a tick
+    self.finished = False
+    self.result = None
+    self.exc_info = None
+    self.wake = wake  # shared by the actions of one request
+
+
+_pending = {}  # hangout id -> [_PendingAction], in the order submitted
+_busy = set()  # hangout ids whose queue has a leader
+_lock = threading.Lock()
+
+
+def _apply(hangout_id, batch):
+  """Apply the batch of actions in one transaction, recording their results
+  (or exceptions).  If the transaction fails, the actions are applied one at
+  a time instead, so that each gets its own result.  Once the transaction
+  has committed, the actions have been applied, so a failure after it (e.g.
+  sending the broadcast) is only logged.
+  """
+  engine = states.GameEngine(hangout_id)
+  try:
+    engine.run_actions([(p.action, p.kwargs) for p in batch])
+  except Exception:
+    if engine.committed:
+      logging.exception("after applying %s actions for hangout %s",
+                        len(batch), hangout_id)
+    elif len(batch) == 1:
+      logging.exception("action %s for hangout %s failed", batch[0].action,
+                        hangout_id)
+      batch[0].exc_info = sys.exc_info()
+      return
+    else:
+      logging.warn("batch of %s actions for hangout %s failed; applying "
+                   "them one at a time", len(batch), hangout_id,
+                   exc_info=True)
+      for p in batch:
+        _apply(hangout_id, [p])
+      return
+  for p, result in zip(batch, engine.results):
+    p.result = result
+
+
+def _tick(hangout_id):
+  """Apply a batch of the hangout's pending actions in one transaction, then
+  pass leadership on.  The batch's requests are woken, and leadership passed
+  on, whatever happens (e.g. a DeadlineExceededError, which isn't an
+  Exception), so that the queue is never left without a leader.
+  """
+  with _lock:
+    queue = _pending.get(hangout_id, [])
+    batch = queue[:config.MAX_ACTIONS_PER_TICK]
+    del queue[:config.MAX_ACTIONS_PER_TICK]
+  logging.info("applying %s queued actions for hangout %s",
+               len(batch), hangout_id)
+  try:
+    if batch:
+      _apply(hangout_id, batch)
+  except:
+    exc_info = sys.exc_info()
+    for p in batch:
+      if not p.exc_info:
+        p.exc_info = exc_info
+    raise
+  finally:
+    for p in batch:
+      p.finished = True
+      p.lead = False
+      p.wake.set()
+    with _lock:
+      queue = _pending.get(hangout_id)
+      if queue:
+        queue[0].lead = True
+        queue[0].wake.set()
+      else:
+        _pending.pop(hangout_id, None)
+        _busy.discard(hangout_id)
+
+
+def _take_over(hangout_id, mine):
+  """If any of the request's actions are still queued, with no request due
+  to lead the queue's next tick, make the request lead it.  Returns whether
+  it did.
+  """
+  with _lock:
+    queue = _pending.get(hangout_id, [])
+    queued = [p for p in mine if p in queue]
+    if not queued or any(p.lead for p in queue):
+      return False
+    _busy.add(hangout_id)
+    queued[0].lead = True
+    return True
+
+
+def submit_all(hangout_id, actions):
+  """Apply a list of (action, kwargs) pairs, in order, to the hangout's
+  current game, batched with any concurrently submitted actions (so that
+  actions submitted together are applied in the same transaction, unless
+  there are more than MAX_ACTIONS_PER_TICK waiting).  Returns the list of
+  GameEngine.apply() results.
+  """
+  wake = threading.Event()
+  mine = [_PendingAction(action, kwargs, wake) for action, kwargs in actions]
+  if not mine:
+    return []
+  with _lock:
+    _pending.setdefault(hangout_id, []).extend(mine)
+    if hangout_id not in _busy:
+      _busy.add(hangout_id)
+      mine[0].lead = True
+  while True:
+    if any(p.lead for p in mine):
+      _tick(hangout_id)
+    if all(p.finished for p in mine):
+      break
+    woken = wake.wait(config.ACTION_QUEUE_WAIT_SECONDS)
+    wake.clear()
+    if not woken and _take_over(hangout_id, mine):
+      logging.warn("no word from the leader of hangout %s's queue in %s s; "
+                   "leading a tick", hangout_id,
+                   config.ACTION_QUEUE_WAIT_SECONDS)
+  for pending in mine:
+    if pending.exc_info:
+      raise pending.exc_info[0], pending.exc_info[1], pending.exc_info[2]
+  return [pending.result for pending in mine]
+
+
+def submit(hangout_id, action, **kwargs):
+  """Apply the action (and any internal transitions it enables) to the
+  hangout's current game, batched with any concurrently submitted actions.
+  Returns the GameEngine.apply() result for the action.
+  """
+  return submit_all(hangout_id, [(action, kwargs)])[0]
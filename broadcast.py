@@ -0,0 +1,122 @@
+"""Fan-out of channel messages to game participants.
+
+Messages are collected in a Broadcast while a state transition runs, and only
+sent once the transition's transaction has committed.  The sends are issued
+concurrently, through the realtime gateway (see gateway.py), on ndb's event
+loop, rather than one synchronous channel.send_message call per participant.
+The public messages are also queued for the game's spectators, and appended
+to its spectator stream (see spectators.py) once, whatever its audience.
+"""
+
+import collections
+import logging
+import time
+
+from ndb import tasklets
+
+import gateway
+import rpcstats
+import spectators
+
+try:
+  import json as simplejson
+except ImportError:
+  from django.utils import simplejson
+
+
+# the number of recent broadcasts kept for stats().
+RECENT_BROADCASTS = 100
+
+
+_recent = collections.deque(maxlen=RECENT_BROADCASTS)
+
+
+def stats():
+  """Summary of the latency (in milliseconds) and size of recent broadcasts."""
+  if not _recent:
+    return {'broadcasts': 0}
+  latencies = sorted(b['latency_ms'] for b in _recent)
+  return {
+      'broadcasts': len(latencies),
+      'messages': sum(b['sent'] for b in _recent),
+      'duplicates': sum(b['duplicates'] for b in _recent),
+      'failures': sum(b['failed'] for b in _recent),
+      'latency_ms_p50': latencies[len(latencies) // 2],
+      'latency_ms_max': latencies[-1],
+  }
+
+
+def _encode(message):
+  """The message as a (utf-8) string, json-encoding it if it's a dict."""
+  if not isinstance(message, basestring):
+    message = simplejson.dumps(message)
+  if isinstance(message, unicode):
+    message = message.encode('utf-8')
+  return message
+
+
+class Broadcast(object):
+  """A batch of channel messages, to be sent together by send().  A message
+  that is queued more than once for the same client is only sent once.
+  """
+
+  def __init__(self):
+    self._queue = []  # (client_id, payload) pairs, in the order added
+    self._seen = set()
+    self._spectated = collections.OrderedDict()  # (hangout, game) -> messages
+    self.duplicates = 0
+    self.latency_ms = None
+
+  def __len__(self):
+    return len(self._queue)
+
+  def add(self, client_ids, message):
+    """Queue message for each of the given channel client ids. message may be
+    a string, or a dict that will be json-encoded (once, for all recipients).
+    """
+    message = _encode(message)
+    for client_id in client_ids:
+      if not client_id:
+        continue
+      if (client_id, message) in self._seen:
+        self.duplicates += 1
+        continue
+      self._seen.add((client_id, message))
+      self._queue.append((client_id, message))
+
+  def spectate(self, hangout_id, game_id, message):
+    """Queue message for the spectators of the given game."""
+    self._spectated.setdefault((hangout_id, game_id), []).append(
+        _encode(message))
+
+  def send(self):
+    """Send all the queued messages concurrently, and wait for them to
+    complete.  Returns the number of messages sent successfully (to players;
+    the spectators' messages are published to their streams).
+    """
+    for (hangout_id, game_id), messages in self._spectated.iteritems():
+      spectators.publish(hangout_id, game_id, messages)
+    self._spectated.clear()
+    if not self._queue:
+      return 0
+    start = time.time()
+    sender = gateway.get_gateway()
+    futures = [sender.send_async(client_id, message)
+               for client_id, message in self._queue]
+    rpcstats.count('gateway.send', sum(len(m) for _, m in self._queue),
+                   len(futures))
+    tasklets.Future.wait_all(futures)
+    sent = 0
+    for fut in futures:
+      if fut.get_exception() is None and fut.get_result():
+        sent += 1
+    self.latency_ms = (time.time() - start) * 1000
+    _recent.append({'sent': sent, 'failed': len(futures) - sent,
+                    'duplicates': self.duplicates,
+                    'latency_ms': self.latency_ms})
+    logging.info(
+        "broadcast %s messages (%s failed, %s duplicates) in %.1f ms",
+        sent, len(futures) - sent, self.duplicates, self.latency_ms)
+    self._queue = []
+    self._seen = set()
+    return sent
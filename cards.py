@@ -1,3 +1,30 @@
+"""Card texts, organized as named card packs.
+
+The 'base' pack is built in (the questions and answers lists below).  Further
+packs are read from packs/<name>.json files, each of the form
+  {"version": "1", "questions": [...], "answers": [...]}
+Only the names of the pack files are read at startup; a pack's cards are
+loaded the first time it is used.  Card numbers are indexes into a pack's
+questions and answers lists, so they are only meaningful within a pack.
+"""
+
+import gzip
+import hashlib
+import logging
+import os
+import re
+import threading
+from cStringIO import StringIO
+
+try:
+  import json as simplejson
+except ImportError:
+  from django.utils import simplejson
+
+DEFAULT_PACK = 'base'
+MAX_IDS_PER_LOOKUP = 500  # the most card ids that parse_ids() will return
+PACKS_DIR = os.path.join(os.path.dirname(__file__), 'packs')
+
 questions = [
   "____________? There's an app for that.",
   "Why can't I sleep at night?",
@@ -67,3 +94,141 @@ answers = [
   "Nickelback.",
   "Heteronormativity.",
 ]
+
+
+class DeckPayload(object):
+  """The json serialization of one of a pack's decks, computed once per
+  process, along with a strong ETag for it and (on first use) its gzipped form.
+  """
+
+  def __init__(self, pack, deck_name, deck):
+    self.body = simplejson.dumps(deck)
+    self.digest = hashlib.md5(self.body).hexdigest()[:16]
+    self.etag = '"%s.%s.%s.%s"' % (
+        pack.name, pack.version, deck_name, self.digest)
+    self._gzipped = None
+
+  @property
+  def gzipped(self):
+    if self._gzipped is None:
+      buf = StringIO()
+      gz = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9)
+      gz.write(self.body)
+      gz.close()
+      self._gzipped = buf.getvalue()
+    return self._gzipped
+
+
+class CardPack(object):
+  """A named, versioned set of question and answer cards."""
+
+  def __init__(self, name, version, questions, answers):
+    self.name = name
+    self.version = version
+    self.questions = questions
+    self.answers = answers
+    self._payloads = {}
+
+  def payload(self, deck_name):
+    """Returns the DeckPayload for the named deck ('questions' or
+    'answers'), or None if there is no such deck.
+    """
+    payload = self._payloads.get(deck_name)
+    if payload is None:
+      if deck_name == 'questions':
+        payload = DeckPayload(self, deck_name, self.questions)
+      elif deck_name == 'answers':
+        payload = DeckPayload(self, deck_name, self.answers)
+      else:
+        return None
+      self._payloads[deck_name] = payload
+    return payload
+
+  def texts(self, deck_name, ids):
+    """Returns a dict mapping each of the given card ids to its text in the
+    named deck.  Ids that are not in the deck are left out.
+    """
+    if deck_name == 'questions':
+      deck = self.questions
+    elif deck_name == 'answers':
+      deck = self.answers
+    else:
+      return {}
+    return dict((i, deck[i]) for i in ids if 0 <= i < len(deck))
+
+  def __repr__(self):
+    return "CardPack(%r, version %r, %s questions, %s answers)" % (
+        self.name, self.version, len(self.questions), len(self.answers))
+
+
+_PACK_NAME_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+
+_packs = {DEFAULT_PACK: CardPack(DEFAULT_PACK, '1', questions, answers)}
+_packs_lock = threading.Lock()
+
+
+def _find_pack_files():
+  """Returns the names of the packs in PACKS_DIR (without loading them)."""
+  if not os.path.isdir(PACKS_DIR):
+    return set()
+  names = set()
+  for filename in os.listdir(PACKS_DIR):
+    name, ext = os.path.splitext(filename)
+    if ext == '.json' and _PACK_NAME_RE.match(name):
+      names.add(name)
+  return names
+
+_pack_files = _find_pack_files()
+
+
+def _load_pack(name):
+  path = os.path.join(PACKS_DIR, name + '.json')
+  with open(path) as f:
+    data = simplejson.load(f)
+  pack = CardPack(name, str(data.get('version', '1')),
+                  data.get('questions', []), data.get('answers', []))
+  logging.info("loaded card pack %s", pack)
+  return pack
+
+
+def parse_ids(spec):
+  """Parse a card id list such as '1,5,9-12' into a sorted list of ids.
+  Returns None if the list is malformed or names more than
+  MAX_IDS_PER_LOOKUP ids.
+  """
+  ids = set()
+  for part in spec.split(','):
+    part = part.strip()
+    if not part:
+      continue
+    try:
+      if '-' in part:
+        first, last = [int(n) for n in part.split('-', 1)]
+      else:
+        first = last = int(part)
+    except ValueError:
+      return None
+    if first < 0 or last < first or (
+        len(ids) + last - first >= MAX_IDS_PER_LOOKUP):
+      return None
+    ids.update(xrange(first, last + 1))
+  return sorted(ids)
+
+
+def pack_names():
+  """The names of all the available packs."""
+  return sorted(set(_packs) | _pack_files)
+
+
+def get_pack(name=None):
+  """Returns the named CardPack (the default pack if name is not given),
+  loading it if necessary, or None if there is no such pack.
+  """
+  name = name or DEFAULT_PACK
+  pack = _packs.get(name)
+  if pack is None and name in _pack_files:
+    with _packs_lock:
+      pack = _packs.get(name)
+      if pack is None:
+        pack = _packs[name] = _load_pack(name)
+  return pack
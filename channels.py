@@ -0,0 +1,149 @@
+"""Channel sessions: the Channel API channel of each player in a hangout.
+
+A player's channel is identified by the hangout and plus id, rather than by
+their Participant entity, so one channel serves the player across all of the
+hangout's games.  Channels are created, and their tokens refreshed, outside
+the game transactions, with concurrent asynchronous calls to the realtime
+gateway (see gateway.py).  Each session records when its token expires, so
+that tokens can be refreshed (and the new token sent to the client over its
+current channel) before they do, and whether the client is connected, as
+reported by the channel_presence inbound service.
+"""
+
+import datetime
+import hashlib
+import logging
+
+from ndb import model
+from ndb import query
+from ndb import tasklets
+
+import broadcast
+import config
+import gateway
+import tasks
+
+
+def client_id_for(hangout_id, plus_id):
+  """The channel client id of the player in the hangout.  (Hashed, since
+  client ids are limited to 64 bytes.)
+  """
+  return hashlib.sha1('%s|%s' % (hangout_id, plus_id)).hexdigest()
+
+
+class ChannelSession(model.Model):
+  """ A player's channel in a hangout, keyed by its client id."""
+
+  hangout_id = model.StringProperty(indexed=False)
+  plus_id = model.StringProperty(indexed=False)
+  token = model.StringProperty(indexed=False)
+  expires_at = model.DateTimeProperty()
+  connected = model.BooleanProperty(default=False, indexed=False)
+  last_seen = model.DateTimeProperty(indexed=False)
+
+  @property
+  def client_id(self):
+    return self.key.id()
+
+  def needs_token(self, now=None):
+    """Whether the session has no token, or one that expires within the
+    refresh margin.
+    """
+    now = now or datetime.datetime.now()
+    margin = datetime.timedelta(minutes=config.CHANNEL_REFRESH_MINUTES)
+    return (not self.token or self.expires_at is None or
+            self.expires_at - now < margin)
+
+
+@tasklets.tasklet
+def _refresh_async(session):
+  start = datetime.datetime.now()
+  session.token = yield gateway.get_gateway().create_token_async(
+      session.client_id, config.CHANNEL_DURATION_MINUTES)
+  session.expires_at = start + datetime.timedelta(
+      minutes=config.CHANNEL_DURATION_MINUTES)
+  yield session.put_async()
+  raise tasklets.Return(session)
+
+
+@tasklets.tasklet
+def get_session_async(hangout_id, plus_id):
+  """Get the player's channel session, creating its channel, or refreshing
+  its token, if need be.  Must not be called within a game transaction.
+  """
+  client_id = client_id_for(hangout_id, plus_id)
+  session = yield model.Key(ChannelSession, client_id).get_async()
+  if not session:
+    session = ChannelSession(id=client_id, hangout_id=hangout_id,
+                             plus_id=plus_id)
+  if session.needs_token():
+    session = yield _refresh_async(session)
+  raise tasklets.Return(session)
+
+
+def get_sessions(hangout_id, plus_ids):
+  """Get the channel sessions of the players in the hangout, concurrently.
+  Returns a dict of plus_id to ChannelSession.
+  """
+  plus_ids = list(set(plus_ids))
+  futures = [get_session_async(hangout_id, plus_id) for plus_id in plus_ids]
+  return dict((plus_id, fut.get_result())
+              for plus_id, fut in zip(plus_ids, futures))
+
+
+def get_session(hangout_id, plus_id):
+  return get_session_async(hangout_id, plus_id).get_result()
+
+
+def mark_presence(client_id, connected):
+  """Record a channel_presence notification for the client id.  Returns the
+  session, or None if the client id isn't a session's.
+  """
+  session = ChannelSession.get_by_id(client_id)
+  if not session:
+    logging.info("presence for unknown channel client %s", client_id)
+    return None
+  session.connected = connected
+  session.last_seen = datetime.datetime.now()
+  session.put()
+  return session
+
+
+def refresh_expiring(now=None, cursor=None):
+  """Refresh the tokens of the connected sessions that will expire within the
+  refresh margin, and send each client its new token over its current
+  channel.  The sessions in the window are paged through CHANNEL_REFRESH_BATCH
+  at a time (from cursor, a websafe cursor string, if given), skipping the
+  disconnected ones, and a task is queued to carry on with the next page, so
+  that however many disconnected sessions there are, the connected ones
+  behind them are reached.  Returns the number of tokens refreshed from this
+  page.
+  """
+  now = now or datetime.datetime.now()
+  margin = datetime.timedelta(minutes=config.CHANNEL_REFRESH_MINUTES)
+  if cursor:
+    cursor = query.Cursor.from_websafe_string(cursor)
+  sessions, next_cursor, more = ChannelSession.query(
+      ChannelSession.expires_at > now,
+      ChannelSession.expires_at < now + margin).fetch_page(
+          config.CHANNEL_REFRESH_BATCH, start_cursor=cursor)
+  if more and next_cursor:
+    tasks.defer(refresh_expiring, now, next_cursor.to_websafe_string())
+  sessions = [s for s in sessions if s.connected]
+  futures = [_refresh_async(s) for s in sessions]
+  tasklets.Future.wait_all(futures)
+  bcast = broadcast.Broadcast()
+  refreshed = 0
+  for fut in futures:
+    if fut.get_exception() is not None:
+      logging.warn("could not refresh channel token: %s", fut.get_exception())
+      continue
+    session = fut.get_result()
+    bcast.add([session.client_id],
+              {'channel_token': session.token,
+               'expires_at': session.expires_at.isoformat()})
+    refreshed += 1
+  bcast.send()
+  logging.info("refreshed %s of %s expiring channel tokens",
+               refreshed, len(sessions))
+  return refreshed
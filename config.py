@@ -3,4 +3,27 @@
 
 # ROUNDS_PER_GAME = 2  # the count starts at 0
 ROUNDS_PER_GAME = 5  # the count starts at 0
-SIZE_OF_HAND = 5  # the number of cards dealt to each participant per game
\ No newline at end of file
+MIN_PLAYERS = 2  # the number of active players needed to start a game
+SIZE_OF_HAND = 5  # the number of cards dealt to each participant per game
+CARDS_MAX_AGE = 86400  # seconds that clients may cache the /api/cards decks
+LEADERBOARD_SHARDS = 4  # counter shards per player per leaderboard
+LEADERBOARD_CACHED = 100  # the number of leaders kept in memcache per board
+LEADERBOARD_REBUILD_SECONDS = 10  # cache misses coalesced per board rebuild
+MAX_ACTIONS_PER_TICK = 20  # actions applied per transaction by actionqueue
+ACTION_QUEUE_WAIT_SECONDS = 10  # wait on a silent queue leader before leading
+ROUND_STEP_TIMEOUT = 120  # seconds players get to select, or to vote, per round
+TIMEOUT_BUCKET_SECONDS = 60  # granularity of the game timeout index
+TIMEOUT_SWEEP_BATCH = 100  # expired games handled per timeout sweep
+MAX_BULK_JOIN = 25  # players seated per /api/bulk_join request
+CHANNEL_DURATION_MINUTES = 120  # lifetime of the channel tokens we create
+CHANNEL_REFRESH_MINUTES = 30  # refresh tokens expiring within this margin
+CHANNEL_REFRESH_BATCH = 100  # expiring sessions examined per refresh page
+PRESENCE_BATCH_SECONDS = 5  # channel presence changes coalesced per hangout
+GATEWAY_QUEUE_SIZE = 100  # messages held per local stream before dropping
+GATEWAY_BATCH_SIZE = 50  # messages written per local stream chunk
+GATEWAY_KEEPALIVE_SECONDS = 15  # idle time before a local stream keepalive
+MAX_COMMANDS = 20  # commands per /api/commands batch
+STATE_HISTORY = 10  # recent game state snapshots kept for /api/state diffs
+RPC_STATS_HEADER = False  # send each request's API call summary in X-RPC-Stats
+SPECTATOR_STREAM_SIZE = 50  # recent public messages kept per game for viewers
+WIRE_DEFLATE_MIN_BYTES = 512  # shorter 'deflate' wire messages aren't deflated
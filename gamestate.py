@@ -0,0 +1,141 @@
+"""Versioned snapshots of a hangout's current game, for clients to resync.
+
+A snapshot is a compact dict of the game's public state (see build).  Each
+change to the game increments its version (see GameSnapshot.commit), which is
+carried on from one game of the hangout to the next, so a client can tell
+which state it has seen, and ask for just the changes since then.
+
+The current snapshot is kept in memcache, and rebuilt from the datastore on a
+miss.  A transition invalidates it by replacing it with a placeholder that
+holds the new version; a snapshot is only cached (with a compare-and-set) if
+no invalidation came in while it was being built, so that a stale snapshot
+can't overwrite a newer invalidation.  The last few snapshots served are also
+kept, to compute the diffs from.
+"""
+
+import logging
+
+from google.appengine.api import memcache
+
+import config
+import models
+
+# the compare-and-set attempts made to add a snapshot to the history, before
+# giving up.
+REMEMBER_ATTEMPTS = 5
+
+
+def _cache_key(hangout_id):
+  return 'state:%s' % (hangout_id,)
+
+
+def _history_key(hangout_id):
+  return 'state-history:%s' % (hangout_id,)
+
+
+def build(hangout_id):
+  """Build the snapshot of the hangout's current game from the datastore.
+  Returns None if there is no current game.
+  """
+  game = models.Hangout.peek_current_game(hangout_id)
+  if not game:
+    return None
+  snapshot = {
+      'game_id': game.key.id(),
+      'version': game.version,
+      'state': game.state,
+      'round': game.current_round,
+      'question': game.current_question,
+      'card_pack': game.card_pack,
+      'players': sorted(game.players),
+      'slots': game.slots,
+      'selected': len(game.selected),
+      'voted': len(game.voted),
+      'paused': game.is_paused,
+      'timeout_at': game.timeout_at and game.timeout_at.isoformat(),
+      'scores': dict((p.plus_id, p.game_score)
+                     for p in game.participants()),
+  }
+  if game.state in ('voting', 'scores'):
+    # sorted, so as not to give away who selected which card.
+    snapshot['selected_cards'] = sorted(game.selected_cards)
+  return snapshot
+
+
+def _remember(hangout_id, snapshot):
+  """Keep the snapshot in the hangout's recent history, for diffs, with a
+  compare-and-set, so that concurrent snapshots don't drop each other.
+  Returns whether it was kept (if not, the clients that ask for the changes
+  since its version get the full state instead).
+  """
+  client = memcache.Client()
+  key = _history_key(hangout_id)
+  for _ in range(REMEMBER_ATTEMPTS):
+    history = client.gets(key)
+    new_history = dict(history or {})
+    new_history[snapshot['version']] = snapshot
+    for version in sorted(new_history)[:-config.STATE_HISTORY]:
+      del new_history[version]
+    if history is None:
+      stored = client.add(key, new_history)
+    else:
+      stored = client.cas(key, new_history)
+    if stored:
+      return True
+  logging.warn("could not keep version %s of hangout %s's state for diffs",
+               snapshot['version'], hangout_id)
+  return False
+
+
+def current(hangout_id):
+  """The snapshot of the hangout's current game, from memcache if possible.
+  Returns None if there is no current game.
+  """
+  client = memcache.Client()
+  key = _cache_key(hangout_id)
+  cached = client.gets(key)
+  if cached is not None and 'game_id' in cached:
+    return cached
+  snapshot = build(hangout_id)
+  if snapshot is None:
+    return None
+  if cached is None:
+    stored = client.add(key, snapshot)
+  elif snapshot['version'] >= cached['version']:
+    stored = client.cas(key, snapshot)
+  else:
+    stored = False
+  if stored:
+    _remember(hangout_id, snapshot)
+  else:
+    logging.info("state of hangout %s changed while building snapshot",
+                 hangout_id)
+  return snapshot
+
+
+def get(hangout_id, since=None):
+  """The state of the hangout's current game, as a dict with its 'version'
+  and either the 'full' snapshot, or, if since is a recent version of the
+  same game, just the 'changes' since then (with None for removed keys).
+  Returns None if there is no current game.
+  """
+  snapshot = current(hangout_id)
+  if snapshot is None:
+    return None
+  result = {'version': snapshot['version']}
+  old = None
+  if since is not None:
+    old = (memcache.get(_history_key(hangout_id)) or {}).get(since)
+  if old is None or old['game_id'] != snapshot['game_id']:
+    result['full'] = snapshot
+    return result
+  result['since'] = since
+  changes = dict((k, v) for k, v in snapshot.iteritems() if old.get(k) != v)
+  changes.update((k, None) for k in old if k not in snapshot)
+  result['changes'] = changes
+  return result
+
+
+def invalidate(hangout_id, version):
+  """Drop the cached snapshot, as of the given (new) version of the game."""
+  memcache.set(_cache_key(hangout_id), {'version': version})
@@ -0,0 +1,260 @@
+"""The realtime gateway: how messages are pushed to the players' clients.
+
+All channel traffic goes through the current gateway (see set_gateway), which
+creates the tokens that clients connect with, and sends messages to a client
+id.  Both are asynchronous, returning ndb Futures, so that a Broadcast can
+issue its sends concurrently.  The backends are:
+
+ - ChannelGateway: the App Engine Channel API (the default).
+ - LocalGateway: an in-process Server-Sent Events backend, for running and
+   load-testing the game outside App Engine with a threaded WSGI server (see
+   localserver.py, which also sets up the SDK's API stubs that this module
+   and the rest of the app import).  Clients connect to
+   /api/stream?token=<token>; each connection has a bounded queue, and the
+   messages waiting in it are written as one batch, gzipped if the client
+   accepts it (see gzip_chunks).  An App Engine request couldn't hold a
+   stream open, so this is never used there.
+ - StubGateway: records the messages sent to each client, optionally with a
+   simulated RPC latency, for benchmarks.
+
+(The local backend uses threads and a Queue per connection rather than
+asyncio, which python 2.7 doesn't have.)
+"""
+
+import collections
+import logging
+import Queue
+import threading
+import time
+import uuid
+import zlib
+
+from google.appengine.api import api_base_pb
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import channel
+from google.appengine.api.channel import channel_service_pb
+from google.appengine.runtime import apiproxy_errors
+
+from ndb import tasklets
+
+import config
+
+
+def _done(result):
+  """A Future that already has the given result."""
+  fut = tasklets.Future()
+  fut.set_result(result)
+  return fut
+
+
+class ChannelGateway(object):
+  """Pushes messages through the Channel API, asynchronously."""
+
+  @tasklets.tasklet
+  def create_token_async(self, client_id, duration_minutes):
+    """Create a channel token for the client id, as channel.create_channel()
+    would, but without blocking.
+    """
+    request = channel_service_pb.CreateChannelRequest()
+    request.set_application_key(client_id)
+    request.set_duration_minutes(duration_minutes)
+    response = channel_service_pb.CreateChannelResponse()
+    rpc = apiproxy_stub_map.UserRPC(channel._GetService())
+    rpc.make_call('CreateChannel', request, response)
+    yield rpc
+    try:
+      rpc.check_success()
+    except apiproxy_errors.ApplicationError, e:
+      raise channel._ToChannelError(e)
+    raise tasklets.Return(response.token())
+
+  @tasklets.tasklet
+  def send_async(self, client_id, message):
+    request = channel_service_pb.SendMessageRequest()
+    request.set_application_key(client_id)
+    request.set_message(message)
+    response = api_base_pb.VoidProto()
+    # use the same service name that channel.send_message() would.
+    rpc = apiproxy_stub_map.UserRPC(channel._GetService())
+    rpc.make_call('SendChannelMessage', request, response)
+    yield rpc
+    try:
+      rpc.check_success()
+    except apiproxy_errors.ApplicationError, e:
+      logging.warn("could not send channel msg to %s: %s", client_id, e)
+      raise tasklets.Return(False)
+    raise tasklets.Return(True)
+
+
+class StubGateway(object):
+  """A stand-in for the Channel API, which records the messages sent to each
+  client instead of delivering them.  An optional per-send delay simulates the
+  RPC latency, so that fan-out to many recipients can be benchmarked locally.
+  """
+
+  def __init__(self, delay=0):
+    self.delay = delay
+    self.messages = collections.defaultdict(list)
+
+  def create_token_async(self, client_id, duration_minutes):
+    return _done('stub-token-%s' % (client_id,))
+
+  @tasklets.tasklet
+  def send_async(self, client_id, message):
+    if self.delay:
+      yield tasklets.sleep(self.delay)
+    self.messages[client_id].append(message)
+    raise tasklets.Return(True)
+
+  def clear(self):
+    self.messages.clear()
+
+
+class _Connection(object):
+  """One client's open event stream."""
+
+  def __init__(self, client_id, queue_size):
+    self.client_id = client_id
+    self.queue = Queue.Queue(queue_size)
+    self.closed = False
+    self.dropped = 0
+
+  def put(self, message):
+    """Queue the message for the client.  If the client isn't keeping up and
+    its queue is full, its oldest message is dropped, so that a slow client
+    never holds up a broadcast or grows without bound.
+    """
+    while True:
+      try:
+        self.queue.put_nowait(message)
+        return
+      except Queue.Full:
+        try:
+          self.queue.get_nowait()
+          self.dropped += 1
+        except Queue.Empty:
+          pass
+
+  def close(self):
+    self.closed = True
+    self.put(None)  # wake up the stream
+
+  def events(self):
+    """Generates the Server-Sent Events stream: each chunk holds all the
+    messages waiting at that point (up to GATEWAY_BATCH_SIZE), with comment
+    lines to keep the connection alive when there are none.
+    """
+    while not self.closed:
+      try:
+        batch = [self.queue.get(timeout=config.GATEWAY_KEEPALIVE_SECONDS)]
+      except Queue.Empty:
+        yield ': keepalive\n\n'
+        continue
+      while len(batch) < config.GATEWAY_BATCH_SIZE:
+        try:
+          batch.append(self.queue.get_nowait())
+        except Queue.Empty:
+          break
+      events = []
+      for message in batch:
+        if message is None:
+          continue
+        events.append(''.join('data: %s\n' % line
+                              for line in message.split('\n')) + '\n')
+      if events:
+        yield ''.join(events)
+
+
+def gzip_chunks(chunks):
+  """Gzip a stream of chunks (e.g. a connection's events()), flushing after
+  each chunk so that it reaches the client as soon as it's written.  Closing
+  the gzipped stream closes the original one.
+  """
+  compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  try:
+    for chunk in chunks:
+      yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+  finally:
+    close = getattr(chunks, 'close', None)
+    if close:
+      close()
+
+
+class LocalGateway(object):
+  """Pushes messages to clients connected to this process with Server-Sent
+  Events.  A client id has at most one open connection; a new connection
+  with the client's token replaces the old one.
+  """
+
+  def __init__(self, queue_size=None):
+    self.queue_size = queue_size or config.GATEWAY_QUEUE_SIZE
+    self._lock = threading.Lock()
+    self._tokens = {}  # token -> (client id, expiry timestamp)
+    self._connections = {}  # client id -> _Connection
+
+  def create_token_async(self, client_id, duration_minutes):
+    token = uuid.uuid4().hex
+    now = time.time()
+    with self._lock:
+      if len(self._tokens) % 256 == 0:
+        self._tokens = dict((t, v) for t, v in self._tokens.iteritems()
+                            if v[1] > now)
+      self._tokens[token] = (client_id, now + duration_minutes * 60)
+    return _done(token)
+
+  def send_async(self, client_id, message):
+    with self._lock:
+      conn = self._connections.get(client_id)
+    if not conn:
+      return _done(False)
+    conn.put(message)
+    return _done(True)
+
+  def connect(self, token):
+    """Open a connection for the client with the given token.  Returns the
+    connection, or None if the token is unknown or has expired.
+    """
+    with self._lock:
+      client_id, expires = self._tokens.get(token, (None, 0))
+      if expires < time.time():
+        self._tokens.pop(token, None)
+        return None
+      conn = _Connection(client_id, self.queue_size)
+      old_conn = self._connections.get(client_id)
+      self._connections[client_id] = conn
+    if old_conn:
+      old_conn.close()
+    return conn
+
+  def disconnect(self, conn):
+    conn.closed = True
+    with self._lock:
+      if self._connections.get(conn.client_id) is conn:
+        del self._connections[conn.client_id]
+        return True
+    return False
+
+  def stats(self):
+    with self._lock:
+      conns = self._connections.values()
+    return {'connections': len(conns),
+            'queued': sum(c.queue.qsize() for c in conns),
+            'dropped': sum(c.dropped for c in conns)}
+
+
+_gateway = ChannelGateway()
+
+
+def set_gateway(gateway):
+  """Replace the gateway used for all channel traffic, e.g. with a
+  LocalGateway or a StubGateway.  Returns the previous gateway.
+  """
+  global _gateway
+  old_gateway = _gateway
+  _gateway = gateway
+  return old_gateway
+
+
+def get_gateway():
+  return _gateway
@@ -0,0 +1,170 @@
+"""Leaderboards of players' accumulated points, per hangout and global.
+
+Points are added from the scoring of each round (by a task, outside the game's
+entity group).  Each player's total on a board is kept in sharded counters, so
+that concurrent updates for the same player don't contend on one entity, and
+the top of each board is kept in memcache, updated incrementally (with
+compare-and-set) as totals change.  On a cache miss, the top is rebuilt from
+the shards by a task, off the request path: the misses within each
+LEADERBOARD_REBUILD_SECONDS slot share one (named) task, run at the slot's
+end, so that it sees the totals updated during the slot.  The rebuilt top is
+only cached if the cache is still empty, so it can't overwrite newer
+incremental updates.
+"""
+
+import calendar
+import datetime
+import hashlib
+import logging
+import zlib
+
+from google.appengine.api import memcache
+from ndb import model
+
+import config
+import tasks
+
+GLOBAL_BOARD = 'global'
+CAS_RETRIES = 5
+UPDATE_RETRY_SECONDS = 1  # delay before retrying a contended top update
+RECENT_EVENTS = 20  # the event ids remembered per shard, to skip repeats
+
+
+def hangout_board(hangout_id):
+  return 'hangout:%s' % (hangout_id,)
+
+
+class ScoreShard(model.Model):
+  """ One shard of a player's points total on a leaderboard."""
+
+  board = model.StringProperty()
+  plus_id = model.StringProperty()
+  points = model.IntegerProperty(default=0, indexed=False)
+  # the ids of the latest events added to this shard, so that a retried
+  # task doesn't count its points twice.
+  recent_events = model.StringProperty(repeated=True, indexed=False)
+
+
+def _shard_keys(board, plus_id):
+  return [model.Key(ScoreShard, '%s|%s|%d' % (board, plus_id, i))
+          for i in range(config.LEADERBOARD_SHARDS)]
+
+
+def _cache_key(board):
+  return 'leaderboard:%s' % (board,)
+
+
+def add_points(board, plus_id, points, event_id):
+  """Add points to the player's total on the board, once per event_id.  The
+  event picks the shard, so a repeat of the event finds its id in that shard.
+  """
+  keys = _shard_keys(board, plus_id)
+  key = keys[zlib.crc32(event_id) % len(keys)]
+
+  def _tx():
+    shard = key.get()
+    if not shard:
+      shard = ScoreShard(key=key, board=board, plus_id=plus_id)
+    if event_id in shard.recent_events:
+      logging.info("points for %s already added to %s", event_id, key)
+      return False
+    shard.points += points
+    shard.recent_events = (shard.recent_events + [event_id])[-RECENT_EVENTS:]
+    shard.put()
+    return True
+  return model.transaction(_tx)
+
+
+def total(board, plus_id):
+  """The player's points total on the board."""
+  return sum(s.points for s in model.get_multi(_shard_keys(board, plus_id))
+             if s)
+
+
+def _top_list(totals):
+  leaders = sorted(totals.items(), key=lambda t: (-t[1], t[0]))
+  return leaders[:config.LEADERBOARD_CACHED]
+
+
+def rebuild(board):
+  """Task: recompute the top of the board from all of its shards, and cache
+  it, unless the cache has been filled in the meantime.  Returns the top.
+  """
+  totals = {}
+  for shard in ScoreShard.query(ScoreShard.board == board).iter():
+    totals[shard.plus_id] = totals.get(shard.plus_id, 0) + shard.points
+  leaders = _top_list(totals)
+  if not memcache.add(_cache_key(board), leaders):
+    logging.info("top of leaderboard %s was cached during its rebuild", board)
+  return leaders
+
+
+def schedule_rebuild(board, now=None):
+  """Queue the rebuild of the board's cached top, at the end of the current
+  LEADERBOARD_REBUILD_SECONDS slot (once per slot).
+  """
+  now = now or datetime.datetime.now()
+  timestamp = calendar.timegm(now.timetuple())
+  slot = timestamp // config.LEADERBOARD_REBUILD_SECONDS
+  countdown = (slot + 1) * config.LEADERBOARD_REBUILD_SECONDS - timestamp
+  tasks.defer(rebuild, board,
+              _name='leaderboard-%s-%d' % (hashlib.md5(board).hexdigest(),
+                                           slot),
+              _countdown=countdown)
+
+
+def _update_top(board, plus_id, new_total):
+  """Update the player's entry in the cached top of the board.  Returns
+  False if it couldn't be updated, for contention.
+  """
+  client = memcache.Client()
+  key = _cache_key(board)
+  for _ in range(CAS_RETRIES):
+    leaders = client.gets(key)
+    if leaders is None:
+      # the rebuild will count the new total.
+      schedule_rebuild(board)
+      return True
+    totals = dict(leaders)
+    if (plus_id not in totals and
+        len(leaders) >= config.LEADERBOARD_CACHED and
+        new_total <= leaders[-1][1]):
+      return True  # not (yet) in the top of the board
+    totals[plus_id] = new_total
+    if client.cas(key, _top_list(totals)):
+      return True
+  return False
+
+
+def update_top(board, plus_id):
+  """Task: update the player's entry in the cached top of the board with
+  their current total, retrying later (rather than dropping the cached top)
+  if there is too much contention.
+  """
+  if not _update_top(board, plus_id, total(board, plus_id)):
+    logging.info("contention on leaderboard %s; retrying the update for %s",
+                 board, plus_id)
+    tasks.defer(update_top, board, plus_id,
+                _countdown=UPDATE_RETRY_SECONDS)
+
+
+def record_points(hangout_id, points, event_id):
+  """Task: add each player's points from one scoring event (e.g. a round) to
+  the hangout's leaderboard and the global one.  points is a dict of plus_id
+  to points.
+  """
+  for board in (hangout_board(hangout_id), GLOBAL_BOARD):
+    for plus_id, p in points.iteritems():
+      if p and add_points(board, plus_id, p, event_id):
+        update_top(board, plus_id)
+
+
+def top(board, limit=10):
+  """The board's top (plus_id, points) pairs, from memcache.  Returns None if
+  the top isn't cached; its rebuild is then queued.
+  """
+  leaders = memcache.get(_cache_key(board))
+  if leaders is None:
+    schedule_rebuild(board)
+    return None
+  return [tuple(t) for t in leaders[:limit]]
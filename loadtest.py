@@ -0,0 +1,653 @@
+"""Load harness: plays many simulated hangouts through main.application.
+
+Each simulated hangout has its players join, starts the game, and plays
+rounds of card selection and voting, by sending requests to the WSGI
+application in-process, with the datastore and memcache provided by the SDK's
+testbed stubs, channel messages recorded by a gateway.StubGateway, and the
+deferred tasks run by a tasks.LocalTaskQueue once each round's voting is
+done.  Hangouts are played concurrently by a number of worker threads.
+
+At the end it reports the latency of each endpoint (p50/p99, in ms), the
+datastore RPCs by method, the transactions and their retries, and the channel
+messages sent per round, e.g.:
+
+  python loadtest.py --sdk ~/google_appengine --hangouts 200 --players 5 \\
+      --rounds 3 --threads 8
+
+Other scenarios (--scenario) exercise one part of the backend directly:
+
+ - rpcs: plays as above, then reports the datastore calls per request of each
+   endpoint.  --save writes them to a file, and --baseline compares them
+   with those saved by an earlier run, to show the gets and puts per request
+   before and after a change.  With --legacy, the games are played through
+   the original endpoints only, so the run can be repeated against the tree
+   from before the game engine (with this file copied into it).
+ - transitions: the time to find the enabled transition, with the compiled
+   dispatch map and by scanning the table (as the old if/elif chains did);
+   then the card selections of half of the hangouts applied one action per
+   transaction, against those of the other half batched in one transaction
+   per hangout.
+ - join_storm: all the players of many hangouts joining at once, each with
+   their own join_game request, and then (in other hangouts) with one
+   bulk_join request per hangout.
+ - leaderboard: the scoring tasks of many hangouts adding their rounds'
+   points to the leaderboards at once, with reads of the global top, and
+   then the tasks they queued (rebuilds, and retries of contended updates
+   of the cached tops).
+"""
+
+import collections
+import optparse
+import os
+import random
+import sys
+import threading
+import time
+
+try:
+  import json as simplejson
+except ImportError:
+  from django.utils import simplejson
+
+
+def setup_sdk(sdk_path):
+  """Put the App Engine SDK (and its bundled libraries) on the path."""
+  if sdk_path:
+    sys.path.insert(0, sdk_path)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+
+
+def setup_testbed():
+  """Activate the SDK's testbed, with the datastore, memcache and task queue
+  stubs.  Returns the testbed.
+  """
+  from google.appengine.ext import testbed as testbed_module
+  testbed = testbed_module.Testbed()
+  testbed.activate()
+  testbed.setup_env(app_id='cah-xhack')
+  testbed.init_datastore_v3_stub()
+  testbed.init_memcache_stub()
+  testbed.init_taskqueue_stub()
+  return testbed
+
+
+def _percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class Stats(object):
+  """The measurements of a run."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.latencies = collections.defaultdict(list)  # path -> [ms]
+    self.errors = collections.defaultdict(int)  # path -> count
+    self.rpcs = collections.defaultdict(int)  # datastore method -> count
+    # path -> datastore method -> count, of the calls made by requests
+    self.endpoint_rpcs = collections.defaultdict(
+        lambda: collections.defaultdict(int))
+    self.transactions = 0
+    self.attempts = 0
+    self.rounds = 0
+
+  def add_latency(self, path, ms, ok):
+    with self._lock:
+      self.latencies[path].append(ms)
+      if not ok:
+        self.errors[path] += 1
+
+  def timed(self, name, func, *args, **kwargs):
+    """Call func, recording its latency under name."""
+    start = time.time()
+    ok = False
+    try:
+      result = func(*args, **kwargs)
+      ok = True
+      return result
+    finally:
+      self.add_latency(name, (time.time() - start) * 1000, ok)
+
+  def count(self, attr, n=1):
+    with self._lock:
+      setattr(self, attr, getattr(self, attr) + n)
+
+  def count_rpc(self, method, path=None):
+    with self._lock:
+      self.rpcs[method] += 1
+      if path:
+        self.endpoint_rpcs[path][method] += 1
+
+  def report(self, elapsed, messages=0):
+    lines = ['%-22s %8s %8s %9s %9s' % (
+        'endpoint', 'requests', 'errors', 'p50 ms', 'p99 ms')]
+    for path in sorted(self.latencies):
+      ms = self.latencies[path]
+      lines.append('%-22s %8d %8d %9.1f %9.1f' % (
+          path, len(ms), self.errors[path], _percentile(ms, 50),
+          _percentile(ms, 99)))
+    requests = sum(len(ms) for ms in self.latencies.values())
+    rounds = max(self.rounds, 1)
+    lines.append('')
+    lines.append('%d requests in %.1f s (%.1f/s); %d rounds played' % (
+        requests, elapsed, requests / elapsed, self.rounds))
+    lines.append('datastore RPCs: %s (%.1f per round)' % (
+        ', '.join('%s=%d' % kv for kv in sorted(self.rpcs.items())),
+        sum(self.rpcs.values()) / float(rounds)))
+    lines.append('transactions: %d, retries: %d' % (
+        self.transactions, self.attempts - self.transactions))
+    lines.append('channel messages: %d (%.1f per round)' % (
+        messages, messages / float(rounds)))
+    return '\n'.join(lines)
+
+
+class Harness(object):
+  """Sets up the stubs, and sends the simulated players' requests."""
+
+  def __init__(self, stats):
+    self.stats = stats
+    self._task_lock = threading.RLock()
+    self._local = threading.local()  # the path of the thread's request
+
+  def setup(self):
+    from google.appengine.api import apiproxy_stub_map
+    self.testbed = setup_testbed()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'loadtest', self._count_rpc, 'datastore_v3')
+
+    from ndb import model
+    try:
+      import gateway
+      import tasks
+    except ImportError:
+      # the tree from before the gateway and the task queue (see --legacy),
+      # which sends its channel messages with the channel API.
+      self.testbed.init_channel_stub()
+      self.gateway = self.queue = None
+    else:
+      self.gateway = gateway.StubGateway()
+      gateway.set_gateway(self.gateway)
+      self.queue = tasks.LocalTaskQueue()
+      tasks.set_queue(self.queue)
+    # count the transactions, and the attempts at each (to see the retries).
+    transaction = model.transaction
+
+    def counting_transaction(callback, **kwds):
+      self.stats.count('transactions')
+
+      def attempt():
+        self.stats.count('attempts')
+        return callback()
+      return transaction(attempt, **kwds)
+    model.transaction = counting_transaction
+
+    import main
+    self.app = main.application
+
+  def teardown(self):
+    self.testbed.deactivate()
+
+  def _count_rpc(self, service, call, request, response):
+    self.stats.count_rpc(call, getattr(self._local, 'path', None))
+
+  def request(self, path, params=None, body=None):
+    """Send a request to the application, in a fresh ndb context (as each
+    App Engine request gets).  Returns the decoded json(p) response.
+    """
+    import urllib
+    import webapp2
+    from ndb import tasklets
+    tasklets.set_context(tasklets.make_default_context())
+    url = path
+    if params is not None:
+      params = dict(params, callback='cb')
+      url = '%s?%s' % (path, urllib.urlencode(params))
+    req = webapp2.Request.blank(url)
+    if body is not None:
+      req.method = 'POST'
+      req.body = simplejson.dumps(body)
+      req.content_type = 'application/json'
+    start = time.time()
+    self._local.path = path
+    try:
+      resp = req.get_response(self.app)
+    finally:
+      self._local.path = None
+    ms = (time.time() - start) * 1000
+    text = resp.body
+    if text.startswith('cb('):
+      text = text[len('cb('):-len(');')]
+    try:
+      data = simplejson.loads(text)
+    except ValueError:
+      data = None
+    ok = resp.status_int == 200 and data is not None and (
+        data.get('status', 'OK') == 'OK')
+    self.stats.add_latency(path, ms, ok)
+    return data
+
+  def run_tasks(self):
+    if self.queue is None:
+      return
+    from ndb import tasklets
+    with self._task_lock:
+      tasklets.set_context(tasklets.make_default_context())
+      self.queue.run()
+
+  def run_concurrently(self, threads, items, func):
+    """Call func(item) for each of the items, from the given number of
+    threads, each with its own ndb context.  Returns the elapsed seconds.
+    """
+    from ndb import tasklets
+    work = list(items)
+    work.reverse()
+    work_lock = threading.Lock()
+
+    def worker():
+      while True:
+        with work_lock:
+          if not work:
+            return
+          item = work.pop()
+        tasklets.set_context(tasklets.make_default_context())
+        func(item)
+
+    start = time.time()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in workers:
+      t.start()
+    for t in workers:
+      t.join()
+    return time.time() - start
+
+  def task_counts(self):
+    """The number of tasks run so far, by function name."""
+    counts = collections.defaultdict(int)
+    for name, _ in self.queue.timings if self.queue else ():
+      counts[name] += 1
+    return dict(counts)
+
+
+class SimulatedHangout(object):
+  """One hangout's players, playing rounds of the game."""
+
+  def __init__(self, harness, hangout_id, players):
+    self.harness = harness
+    self.hangout_id = hangout_id
+    self.players = ['%s-p%d' % (hangout_id, i) for i in range(players)]
+    self.hands = {}
+    self.game_id = None
+
+  def _get(self, path, **params):
+    return self.harness.request(
+        path, dict(params, hangout_id=self.hangout_id))
+
+  def join(self):
+    for plus_id in self.players:
+      resp = self._get('/api/join_game', plus_id=plus_id)
+      self.game_id = resp['game_id']
+      self.hands[plus_id] = list(resp['cards'])
+
+  def _refresh_hands(self):
+    """Fetch the players' hands, as of the current game."""
+    for plus_id in self.players:
+      resp = self.harness.request(
+          '/api/commands', body={'hangout_id': self.hangout_id,
+                                 'plus_id': plus_id,
+                                 'commands': [{'cmd': 'state'}]})
+      state = resp['results'][0]
+      self.game_id = state['game_id']
+      self.hands[plus_id] = list(state['cards'] or [])
+
+  def play_round(self):
+    state = self._get('/api/state')['full']
+    if state['game_id'] != self.game_id:
+      self._refresh_hands()
+    if state['state'] == 'new':
+      self._get('/api/start_game')
+    selections = {}
+    for plus_id in self.players:
+      if not self.hands[plus_id]:
+        continue
+      card = random.choice(self.hands[plus_id])
+      self.hands[plus_id].remove(card)
+      selections[plus_id] = card
+      self._get('/api/select_card', plus_id=plus_id, card_num=card)
+    state = self._get('/api/state')['full']
+    cards = state.get('selected_cards') or []
+    for plus_id in self.players:
+      choices = [c for c in cards if c != selections.get(plus_id)]
+      if choices:
+        self._get('/api/vote', plus_id=plus_id,
+                  card_num=random.choice(choices))
+    # scoring, and setting up the next round, are done by tasks.
+    self.harness.run_tasks()
+    self.harness.stats.count('rounds')
+
+
+class LegacyHangout(SimulatedHangout):
+  """One hangout's players, playing rounds through the original endpoints
+  only (join_game, select_card and vote), so that the same run can be made
+  against the tree from before the game engine (see --legacy).  That tree
+  has no start_game, state or command endpoints, so the harness starts each
+  new game, and reads the players' hands, from the datastore directly,
+  outside of any request (so these aren't counted against an endpoint).
+  """
+
+  def _start_game(self):
+    import models
+    from ndb import tasklets
+    tasklets.set_context(tasklets.make_default_context())
+    game = models.Hangout.get_by_id(self.hangout_id).current_game.get()
+    if game.state == 'new':
+      game.state = 'start_round'
+      game.put()
+    if game.key.id() != self.game_id:
+      self.game_id = game.key.id()
+      for p in models.Participant.query(ancestor=game.key).fetch():
+        self.hands[p.plus_id] = list(p.cards)
+
+  def play_round(self):
+    self._start_game()
+    selections = {}
+    for plus_id in self.players:
+      if not self.hands.get(plus_id):
+        continue
+      card = random.choice(self.hands[plus_id])
+      self.hands[plus_id].remove(card)
+      selections[plus_id] = card
+      self._get('/api/select_card', plus_id=plus_id, card_num=card)
+    for plus_id in self.players:
+      choices = [c for p, c in selections.iteritems() if p != plus_id]
+      if choices:
+        self._get('/api/vote', plus_id=plus_id,
+                  card_num=random.choice(choices))
+    # (the original tree scored the round in the last vote's request.)
+    self.harness.run_tasks()
+    self.harness.stats.count('rounds')
+
+
+def run_game(harness, options):
+  """Scenario: play games in many hangouts at once."""
+  if options.legacy:
+    hangout_class = LegacyHangout
+  else:
+    hangout_class = SimulatedHangout
+  hangouts = [hangout_class(harness, 'load%d' % i, options.players)
+              for i in range(options.hangouts)]
+
+  def play(hangout):
+    hangout.join()
+    for _ in range(options.rounds):
+      hangout.play_round()
+
+  elapsed = harness.run_concurrently(options.threads, hangouts, play)
+  messages = 0
+  if harness.gateway:
+    messages = sum(len(m) for m in harness.gateway.messages.values())
+  print harness.stats.report(elapsed, messages)
+
+
+def run_leaderboard(harness, options):
+  """Scenario: the scoring tasks of many hangouts' rounds adding points to
+  the leaderboards at once (each one to its hangout's board and the global
+  one), each followed by a read of the global top.
+  """
+  import leaderboard
+  stats = harness.stats
+  scorings = [(i % options.hangouts, i // options.hangouts)
+              for i in range(options.hangouts * options.rounds)]
+
+  def score(scoring):
+    hangout_num, round_num = scoring
+    hangout_id = 'load%d' % (hangout_num,)
+    points = dict(('%s-p%d' % (hangout_id, i), random.randint(0, 3))
+                  for i in range(options.players))
+    stats.timed('record_points', leaderboard.record_points, hangout_id,
+                points, '%s-r%d' % (hangout_id, round_num))
+    stats.timed('top', leaderboard.top, leaderboard.GLOBAL_BOARD)
+    stats.count('rounds')
+
+  elapsed = harness.run_concurrently(options.threads, scorings, score)
+  print stats.report(elapsed)
+  start = time.time()
+  harness.run_tasks()
+  print 'then ran tasks in %.1f s: %s' % (
+      time.time() - start,
+      ', '.join('%s=%d' % kv for kv in sorted(harness.task_counts().items())))
+  print 'global top: %s' % (leaderboard.top(leaderboard.GLOBAL_BOARD, 3),)
+
+
+# the datastore calls reported by the rpcs scenario.
+DATASTORE_CALLS = ('BeginTransaction', 'Get', 'Put', 'RunQuery', 'Next',
+                   'Commit')
+
+
+def run_rpcs(harness, options):
+  """Scenario: play games as for 'game', then report each endpoint's
+  datastore calls per request, optionally against a saved baseline.  The
+  calls are counted by the harness (not by rpcstats.py), so that the
+  scenario also runs, with --legacy, against the tree from before rpcstats.
+  """
+  stats = harness.stats
+  run_game(harness, options)
+  per_request = {}
+  for path, calls in stats.endpoint_rpcs.iteritems():
+    requests = float(len(stats.latencies[path]))
+    per_request[path] = dict((call, calls.get(call, 0) / requests)
+                             for call in DATASTORE_CALLS)
+  baseline = {}
+  if options.baseline:
+    with open(options.baseline) as f:
+      baseline = simplejson.load(f)
+  print
+  print '%-22s %s' % ('datastore calls/request',
+                      ' '.join('%16s' % call for call in DATASTORE_CALLS))
+  for path in sorted(per_request):
+    cells = []
+    for call in DATASTORE_CALLS:
+      now = per_request[path][call]
+      before = baseline.get(path, {}).get(call)
+      if before is None:
+        cells.append('%16.2f' % now)
+      else:
+        cells.append('%16s' % ('%.2f (%+.2f)' % (now, now - before)))
+    print '%-22s %s' % (path, ' '.join(cells))
+  if baseline:
+    print '(in parentheses: the change from %s)' % (options.baseline,)
+  if options.save:
+    with open(options.save, 'w') as f:
+      simplejson.dump(per_request, f, indent=1, sort_keys=True)
+
+
+def _scan_transitions(snapshot, action, **kwargs):
+  """The first enabled transition for the action, found by scanning the
+  whole table (as the per-state if/elif chains did, before the table was
+  compiled into a dispatch map).
+  """
+  import states
+  for t in states.TRANSITIONS:
+    if (t.state == snapshot.game.state and t.action == action and
+        (t.guard is None or t.guard(snapshot, **kwargs))):
+      return t
+  return None
+
+
+# the lookups timed per action by the transitions scenario's dispatch
+# microbenchmark.
+DISPATCH_LOOKUPS = 5000
+
+
+def run_transitions(harness, options):
+  """Scenario: transition throughput.  Times finding the enabled transition
+  with the compiled dispatch map, against scanning the table; then has the
+  players of half of the hangouts select their cards one action per
+  transaction, and those of the other half in one batch per hangout.
+  """
+  import states
+  from ndb import tasklets
+  stats = harness.stats
+  hangouts = [SimulatedHangout(harness, 'load%d' % i, options.players)
+              for i in range(max(options.hangouts, 2))]
+
+  def start(hangout):
+    hangout.join()
+    hangout._get('/api/start_game')
+
+  harness.run_concurrently(options.threads, hangouts, start)
+
+  tasklets.set_context(tasklets.make_default_context())
+  hangout_id = hangouts[0].hangout_id
+  snapshot = states.GameSnapshot.load(hangout_id)
+  engine = states.GameEngine(hangout_id)
+  game = snapshot.game
+  lookups = [
+      ('select_card', {}),
+      (None, {}),
+      ('timeout', {'game_id': game.key.id(),
+                   'round_num': game.current_round}),
+      ('vote', {}),
+      ('set_playing', {}),
+  ]
+  print 'dispatch, in state %s (us per lookup):' % (game.state,)
+  print '%-14s %10s %10s' % ('action', 'compiled', 'scan')
+  for action, kwargs in lookups:
+    cells = []
+    for find in (engine._first_enabled, _scan_transitions):
+      start_time = time.time()
+      for _ in xrange(DISPATCH_LOOKUPS):
+        find(snapshot, action, **kwargs)
+      cells.append((time.time() - start_time) * 1e6 / DISPATCH_LOOKUPS)
+    print '%-14s %10.2f %10.2f' % ((action or '(internal)',) + tuple(cells))
+
+  def selections(hangout):
+    return [('select_card', {'plus_id': plus_id,
+                             'card_num': random.choice(hangout.hands[plus_id])})
+            for plus_id in hangout.players]
+
+  def one_per_transaction(hangout):
+    engine = states.GameEngine(hangout.hangout_id)
+    for action, kwargs in selections(hangout):
+      stats.timed('select_card', engine.run_action, action, **kwargs)
+
+  def batched(hangout):
+    engine = states.GameEngine(hangout.hangout_id)
+    stats.timed('select_card batch', engine.run_actions, selections(hangout))
+
+  half = len(hangouts) // 2
+  print
+  print '%-22s %8s %8s %9s %13s %8s %12s' % (
+      'selections', 'actions', 'seconds', 'actions/s', 'transactions',
+      'retries', 'p50 ms/call')
+  for name, timed_name, select, group in (
+      ('one per transaction', 'select_card', one_per_transaction,
+       hangouts[:half]),
+      ('batched per hangout', 'select_card batch', batched,
+       hangouts[half:])):
+    transactions, attempts = stats.transactions, stats.attempts
+    elapsed = harness.run_concurrently(options.threads, group, select)
+    actions = len(group) * options.players
+    transactions = stats.transactions - transactions
+    print '%-22s %8d %8.1f %9.1f %13d %8d %12.1f' % (
+        name, actions, elapsed, actions / elapsed, transactions,
+        stats.attempts - attempts - transactions,
+        _percentile(stats.latencies[timed_name], 50))
+
+
+def run_join_storm(harness, options):
+  """Scenario: the players of many hangouts all joining at once, first each
+  with their own /api/join_game request (those of a hangout contending for
+  its entity group), then, in other hangouts, with one /api/bulk_join per
+  hangout.
+  """
+  import config
+  stats = harness.stats
+  dealt = []  # the number of players dealt a hand, per request
+
+  def players(hangout_id):
+    return ['%s-p%d' % (hangout_id, i) for i in range(options.players)]
+
+  def join_one(join):
+    hangout_id, plus_id = join
+    resp = harness.request('/api/join_game', {'hangout_id': hangout_id,
+                                              'plus_id': plus_id})
+    dealt.append(1 if resp and resp.get('cards') else 0)
+
+  def join_bulk(hangout_id):
+    plus_ids = players(hangout_id)
+    for i in range(0, len(plus_ids), config.MAX_BULK_JOIN):
+      resp = harness.request(
+          '/api/bulk_join',
+          {'hangout_id': hangout_id,
+           'plus_ids': ','.join(plus_ids[i:i + config.MAX_BULK_JOIN])})
+      seated = (resp or {}).get('players', {})
+      dealt.append(len([p for p in seated.values() if p['cards']]))
+
+  print '%-12s %8s %8s %8s %13s %8s' % (
+      'joins', 'players', 'dealt', 'seconds', 'transactions', 'retries')
+  total = 0
+  for name, prefix, join in (('join_game', 'storm', join_one),
+                             ('bulk_join', 'bulk', join_bulk)):
+    hangout_ids = ['%s%d' % (prefix, i) for i in range(options.hangouts)]
+    if join is join_one:
+      items = [(h, p) for h in hangout_ids for p in players(h)]
+    else:
+      items = hangout_ids
+    transactions, attempts = stats.transactions, stats.attempts
+    del dealt[:]
+    elapsed = harness.run_concurrently(options.threads, items, join)
+    total += elapsed
+    transactions = stats.transactions - transactions
+    print '%-12s %8d %8d %8.1f %13d %8d' % (
+        name, options.hangouts * options.players, sum(dealt),
+        elapsed, transactions, stats.attempts - attempts - transactions)
+  print
+  print stats.report(total)
+
+
+SCENARIOS = {
+    'game': run_game,
+    'join_storm': run_join_storm,
+    'leaderboard': run_leaderboard,
+    'rpcs': run_rpcs,
+    'transitions': run_transitions,
+}
+
+
+def run(options):
+  harness = Harness(Stats())
+  harness.setup()
+  try:
+    SCENARIOS[options.scenario](harness, options)
+  finally:
+    harness.teardown()
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('--sdk', help='path to the App Engine SDK')
+  parser.add_option('--scenario', default='game', choices=sorted(SCENARIOS),
+                    help='one of: %s' % ', '.join(sorted(SCENARIOS)))
+  parser.add_option('--hangouts', type='int', default=50)
+  parser.add_option('--players', type='int', default=4)
+  parser.add_option('--rounds', type='int', default=3)
+  parser.add_option('--threads', type='int', default=4)
+  parser.add_option('--seed', type='int', help='random seed, for repeat runs')
+  parser.add_option('--legacy', action='store_true',
+                    help='game, rpcs: play through the original endpoints '
+                    'only (join_game, select_card and vote), as the tree '
+                    'from before the game engine has')
+  parser.add_option('--save', help='rpcs: save the calls per request here')
+  parser.add_option('--baseline',
+                    help='rpcs: compare with the calls saved by --save')
+  options, _ = parser.parse_args(argv[1:])
+  if options.players < 2:
+    parser.error('need at least 2 players per hangout, to vote')
+  setup_sdk(options.sdk or os.environ.get('APPENGINE_SDK'))
+  random.seed(options.seed)
+  run(options)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
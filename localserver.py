@@ -0,0 +1,116 @@
+"""Runs the game outside App Engine, on a threaded WSGI server.
+
+The datastore, memcache and task queue are the SDK's in-memory testbed stubs
+(set up as for loadtest.py), the deferred tasks are run by a background
+thread from a tasks.LocalTaskQueue, and channel messages are pushed to the
+clients as Server-Sent Events by a gateway.LocalGateway: a client opens
+/api/stream?token=<channel_token> with the token it got when joining.  The
+static files are served from ./static.  Everything is lost when the server
+stops.  For example:
+
+  python localserver.py --sdk ~/google_appengine --port 8080
+"""
+
+import logging
+import mimetypes
+import optparse
+import os
+import SocketServer
+import sys
+import threading
+import time
+from wsgiref import simple_server
+
+import loadtest
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'static')
+# how often the background thread runs the queued tasks.
+TASK_INTERVAL_SECONDS = 1
+
+
+class _ThreadingWSGIServer(SocketServer.ThreadingMixIn,
+                           simple_server.WSGIServer):
+  daemon_threads = True
+
+
+class _QuietHandler(simple_server.WSGIRequestHandler):
+
+  def log_message(self, format, *args):
+    logging.debug(format, *args)
+
+
+class LocalApp(object):
+  """Serves the static files, and passes everything else to the app, in a
+  fresh ndb context per request (as each App Engine request gets).
+  """
+
+  def __init__(self, app):
+    self.app = app
+
+  def _static(self, path, start_response):
+    filename = os.path.normpath(os.path.join(STATIC_DIR, path))
+    if not filename.startswith(STATIC_DIR) or not os.path.isfile(filename):
+      start_response('404 Not Found', [('Content-Type', 'text/plain')])
+      return ['not found']
+    content_type = mimetypes.guess_type(filename)[0] or 'text/plain'
+    with open(filename, 'rb') as f:
+      body = f.read()
+    start_response('200 OK', [('Content-Type', content_type),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+  def __call__(self, environ, start_response):
+    path = environ.get('PATH_INFO', '')
+    if path.startswith('/static/'):
+      return self._static(path[len('/static/'):], start_response)
+    from ndb import tasklets
+    tasklets.set_context(tasklets.make_default_context())
+    return self.app(environ, start_response)
+
+
+def _run_tasks(queue):
+  from ndb import tasklets
+  while True:
+    time.sleep(TASK_INTERVAL_SECONDS)
+    tasklets.set_context(tasklets.make_default_context())
+    try:
+      queue.run()
+    except Exception:
+      logging.exception("task failed")
+
+
+def serve(options):
+  loadtest.setup_testbed()
+  import gateway
+  import tasks
+  gateway.set_gateway(gateway.LocalGateway())
+  queue = tasks.LocalTaskQueue()
+  tasks.set_queue(queue)
+  runner = threading.Thread(target=_run_tasks, args=(queue,))
+  runner.daemon = True
+  runner.start()
+  import main
+  server = simple_server.make_server(
+      options.host, options.port, LocalApp(main.application),
+      server_class=_ThreadingWSGIServer, handler_class=_QuietHandler)
+  logging.info("serving on http://%s:%s/", options.host, options.port)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('--sdk', help='path to the App Engine SDK')
+  parser.add_option('--host', default='localhost')
+  parser.add_option('--port', type='int', default=8080)
+  options, _ = parser.parse_args(argv[1:])
+  loadtest.setup_sdk(options.sdk or os.environ.get('APPENGINE_SDK'))
+  logging.getLogger().setLevel(logging.INFO)
+  serve(options)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -1,15 +1,25 @@
-import uuid
-import random
+import hashlib
 import webapp2
 from webapp2_extras import jinja2
 from ndb import model
+from ndb import query
 import logging
 
-from google.appengine.api import channel
+from google.appengine.api import datastore_errors
 
+import actionqueue
+import broadcast
+import cards
+import channels
+import config
+import gamestate
+import gateway
+import leaderboard
 import models
+import rpcstats
+import spectators
 import states
-import cards
+import wire
 
 try:
   import json as simplejson
@@ -31,6 +41,10 @@ class BaseHandler(webapp2.RequestHandler):
     self.response.write("%s(%s);" % (self.request.GET['callback'],
                                      simplejson.dumps(response)))
 
+  def render_json(self, response):
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(simplejson.dumps(response))
+
   def accumulate_response(self, rdict):
     """ builds a message dict (to be returned to the client as json).
     """
@@ -50,6 +64,46 @@ class BaseHandler(webapp2.RequestHandler):
       self.render_jsonp(self.resp)
 
 
+def _player_info(game, participant, pack):
+  """The info sent to a player about their seat in the game."""
+  info = {
+      'cards': participant.cards,
+      'channel_token': participant.channel_token,
+  }
+  if participant.inline_card_text and pack:
+    info['card_text'] = pack.texts('answers', participant.cards)
+    if game.current_question is not None:
+      info['question_text'] = pack.texts(
+          'questions', [game.current_question]).get(game.current_question)
+  if participant.wire_format in (wire.COMPACT, wire.DEFLATE):
+    # the player slots that the compact messages refer to.
+    info['wire'] = participant.wire_format
+    info['slot'] = game.slots.index(participant.plus_id)
+    info['slots'] = game.slots
+  return info
+
+
+def _wire_format(requested):
+  """The wire format that a client asked for, if it's one we have (see
+  wire.py); otherwise None, to leave the player's format as it is.
+  """
+  if requested in wire.FORMATS:
+    return requested
+  return None
+
+
+def _join(hangout_id, joins, wire_format=None):
+  """Seat the players in the hangout's current game (see
+  Hangout.join_current_game), after setting up their channels.
+  """
+  sessions = channels.get_sessions(
+      hangout_id, [plus_id for plus_id, _ in joins])
+  game, participants = models.Hangout.join_current_game(
+      hangout_id, joins, sessions, wire_format)
+  gamestate.invalidate(hangout_id, game.version)
+  return game, participants
+
+
 class JoinGameHandler(BaseHandler):
   """ Handles a request to join the current game.  Players can join at any
   time.
@@ -57,22 +111,67 @@ class JoinGameHandler(BaseHandler):
 
   def get(self):
     hangout_id = self.request.GET['hangout_id']
-    game = models.Hangout.get_current_game(hangout_id)
     plus_id = self.request.GET['plus_id']
+    # the client can ask for the texts of the cards it is sent to be included
+    # in the responses and messages, unless it already has the full decks
+    # cached (as indicated by the version of the game's card pack).
+    cached_version = None
+    if self.request.get('inline_text'):
+      cached_version = self.request.get('card_pack_version')
     # add the participant, and in the process, deal their hand from
     # the game cards.
-    participant = models.Participant.get_or_create_participant(
-        game.key, plus_id)
+    game, participants = _join(hangout_id, [(plus_id, cached_version)],
+                               _wire_format(self.request.get('wire')))
+    participant = participants[0]
     logging.info("created participant: %s", participant)
     # TODO - might need to return more info here eventually.
     response = {
-        'cards': participant.cards,
         'game_id': game.key.id(),
-        'channel_token': participant.channel_token,
+        'card_pack': game.card_pack,
+        'card_pack_version': game.card_pack_version,
     }
+    response.update(_player_info(game, participant, game.pack()))
     self.render_jsonp(response)
 
 
+class BulkJoinHandler(BaseHandler):
+  """ Seats several players in the current game at once (e.g. when a whole
+  hangout starts playing together), in a single transaction.  plus_ids is a
+  comma-separated list; inline_text, card_pack_version and wire apply to all
+  of the players, as for join_game.
+  """
+
+  def get(self):
+    hangout_id = self.request.get('hangout_id')
+    plus_ids = [p for p in self.request.get('plus_ids').split(',') if p]
+    if not hangout_id or not plus_ids:
+      self.render_jsonp(
+          {'status': 'ERROR',
+           'message': "Hangout ID or plus IDs not given."})
+      return
+    if len(plus_ids) > config.MAX_BULK_JOIN:
+      self.render_jsonp(
+          {'status': 'ERROR',
+           'message': "Can't join more than %s players at once." % (
+               config.MAX_BULK_JOIN,)})
+      return
+    cached_version = None
+    if self.request.get('inline_text'):
+      cached_version = self.request.get('card_pack_version')
+    game, participants = _join(
+        hangout_id, [(plus_id, cached_version) for plus_id in plus_ids],
+        _wire_format(self.request.get('wire')))
+    logging.info("joined %s players to game %s", len(participants), game.key)
+    pack = game.pack()
+    self.render_jsonp(
+        {'status': 'OK',
+         'game_id': game.key.id(),
+         'card_pack': game.card_pack,
+         'card_pack_version': game.card_pack_version,
+         'players': dict((p.plus_id, _player_info(game, p, pack))
+                         for p in participants)})
+
+
 class LeaveGameHandler(BaseHandler):
   """ Handles reqeusts to leave the current game."""
 
@@ -80,16 +179,28 @@ class LeaveGameHandler(BaseHandler):
     hangout_id = self.request.GET['hangout_id']
     plus_id = self.request.GET['plus_id']
     channel_token = self.request.GET['channel_token']
-    participant_key = model.Key(models.Game, hangout_id,
-                                models.Participant, plus_id)
-    participant = participant_key.get()
-    if participant.channel_token == channel_token:
-      # Remove user from game
-      participant.playing = False
-      participant.put()
+    hangout = models.Hangout.get_by_id(hangout_id)
+    participant = None
+    if hangout and hangout.current_game:
+      participant = model.Key(models.Participant, plus_id,
+                              parent=hangout.current_game).get()
+    # the token may have been refreshed since the participant was created.
+    session = channels.ChannelSession.get_by_id(
+        channels.client_id_for(hangout_id, plus_id))
+    tokens = [participant and participant.channel_token,
+              session and session.token]
+    if not participant or channel_token not in tokens:
+      self.render_jsonp({'status': 'ERROR'})
+      return
+    # Remove user from game (via the GameEngine, so that the round doesn't
+    # wait for them).
+    left_p, _ = actionqueue.submit(
+        hangout_id, 'set_playing', game_id=hangout.current_game.id(),
+        playing={plus_id: False}, handler=self)
+    if left_p:
       self.render_jsonp({'status': 'OK'})
     else:
-      self.render_jsonp({'status': 'ERROR'})
+      self.render_jresp()
 
 
 class SendMessageHandler(BaseHandler):
@@ -106,39 +217,453 @@ class SendMessageHandler(BaseHandler):
            'message': 'message or hangout id not specified.'})
       return
     game = models.Game.get_or_insert(hangout_id)
-    participants = models.Participant.query(
-        models.Participant.playing == True,
-        ancestor=game.key).fetch()
-    for participant in participants:
-      channel.send_message(participant.channel_id, message)
+    game.message_all_participants(message)
     self.render_jsonp({'status': 'OK'})
 
 
+def _accepts_gzip(accept_encoding):
+  """Whether an Accept-Encoding header value accepts gzip, going by its
+  q-values (so e.g. 'gzip;q=0' doesn't).
+  """
+  qualities = {}
+  for item in accept_encoding.split(','):
+    parts = [p.strip() for p in item.split(';')]
+    coding = parts[0].lower()
+    if not coding:
+      continue
+    q = 1.0
+    for param in parts[1:]:
+      if param.lower().startswith('q='):
+        try:
+          q = float(param[2:])
+        except ValueError:
+          q = 0.0
+    qualities[coding] = q
+  return qualities.get('gzip', qualities.get('*', 0.0)) > 0
+
+
 class CardMappingHandler(BaseHandler):
   """ Send the client the card deck list info, so card numbers can be mapped
-  to their text client-side.
+  to their text client-side.  The card pack defaults to the base pack.
+  The decks are serialized once per process (see cards.DeckPayload), and
+  served with an ETag and caching headers.  Without a 'callback' argument, the
+  deck is returned as plain (optionally gzipped) json rather than jsonp.
   """
-  # it should be sufficient just to pass the json-ified arrays.
+
+  def _render(self, response):
+    if 'callback' in self.request.GET:
+      self.render_jsonp(response)
+    else:
+      self.render_json(response)
+
+  def _etag_matches(self, etag):
+    if_none_match = self.request.headers.get('If-None-Match', '')
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return etag in tags or '*' in tags
+
   def get(self):
     deck = self.request.get('deck')
     if not deck:
-      self.render_jsonp(
+      self._render(
           {'status': 'ERROR',
            'message': 'Deck not specified.'})
       return
-    if deck == 'answers':
-      self.render_jsonp(cards.answers)
-    elif deck == 'questions':
-      self.render_jsonp(cards.questions)
+    pack_name = self.request.get('pack')
+    pack = cards.get_pack(pack_name)
+    if not pack:
+      self._render(
+          {'status': 'ERROR',
+           'message': 'Unknown card pack %s' % pack_name})
+      return
+    payload = pack.payload(deck)
+    if not payload:
+      self._render(
+          {'status': 'ERROR',
+           'message': 'Unknown deck %s' % deck})
+      return
+    callback = self.request.GET.get('callback')
+    gzipped = not callback and _accepts_gzip(
+        self.request.headers.get('Accept-Encoding', ''))
+    if callback:
+      # the jsonp body depends on the callback name, and so must its etag.
+      etag = '"%s.%s"' % (payload.etag.strip('"'),
+                          hashlib.md5(callback.encode('utf-8')).hexdigest()[:8])
+    elif gzipped:
+      # each encoding of the body has its own etag.
+      etag = '"%s-gzip"' % (payload.etag.strip('"'),)
     else:
+      etag = payload.etag
+    self.response.headers['ETag'] = etag
+    self.response.headers['Cache-Control'] = (
+        'public, max-age=%d' % config.CARDS_MAX_AGE)
+    self.response.headers['Vary'] = 'Accept-Encoding'
+    if self._etag_matches(etag):
+      self.response.set_status(304)
+      return
+    if callback:
+      self.response.headers['Content-Type'] = 'application/javascript'
+      self.response.write("%s(%s);" % (callback, payload.body))
+    else:
+      self.response.headers['Content-Type'] = 'application/json'
+      if gzipped:
+        self.response.headers['Content-Encoding'] = 'gzip'
+        self.response.write(payload.gzipped)
+      else:
+        self.response.write(payload.body)
+
+
+class CardTextHandler(BaseHandler):
+  """ Look up the texts of just the given cards, e.g. those in a player's
+  hand, rather than fetching a whole deck.  'ids' is a list of card numbers
+  and ranges, like '1,5,9-12'.
+  """
+
+  def get(self):
+    deck = self.request.get('deck')
+    if deck not in ('answers', 'questions'):
       self.render_jsonp(
           {'status': 'ERROR',
            'message': 'Unknown deck %s' % deck})
+      return
+    pack_name = self.request.get('pack')
+    pack = cards.get_pack(pack_name)
+    if not pack:
+      self.render_jsonp(
+          {'status': 'ERROR',
+           'message': 'Unknown card pack %s' % pack_name})
+      return
+    ids = cards.parse_ids(self.request.get('ids'))
+    if ids is None:
+      self.render_jsonp(
+          {'status': 'ERROR',
+           'message': 'Card ids not properly specified (at most %s).' % (
+               cards.MAX_IDS_PER_LOOKUP,)})
+      return
+    self.render_jsonp(
+        {'status': 'OK', 'pack': pack.name, 'card_pack_version': pack.version,
+         'deck': deck, 'cards': pack.texts(deck, ids)})
+
+
+class SelectPackHandler(BaseHandler):
+  """ Select the card pack for a hangout's games.  The pack is used from the
+  hangout's next new game on.  Without a 'pack' argument, lists the available
+  packs.
+  """
+
+  def get(self):
+    hangout_id = self.request.get('hangout_id')
+    pack_name = self.request.get('pack')
+    if not pack_name:
+      self.render_jsonp({'status': 'OK', 'packs': cards.pack_names()})
+      return
+    if not hangout_id:
+      self.render_jsonp(
+          {'status': 'ERROR',
+           'message': "Hangout ID not given."})
+      return
+    if not cards.get_pack(pack_name):
+      self.render_jsonp(
+          {'status': 'ERROR',
+           'message': 'Unknown card pack %s' % pack_name})
+      return
+
+    def _tx():
+      hangout = models.Hangout.get_by_id(hangout_id)
+      if not hangout:
+        hangout = models.Hangout(id=hangout_id)
+      hangout.card_pack = pack_name
+      hangout.put()
+    model.transaction(_tx)
+    self.render_jsonp({'status': 'OK', 'pack': pack_name})
+
+
+class HistoryHandler(BaseHandler):
+  """ Return a page of a hangout's round history (oldest first), or with
+  'leaderboard' set, the players' point totals over that history.  With
+  'current_game' set, only the current game's rounds are included.
+  """
+
+  def get(self):
+    hangout_id = self.request.get('hangout_id')
+    if not hangout_id:
+      self.render_jsonp(
+          {'status': 'ERROR',
+           'message': "Hangout ID not given."})
+      return
+    game = None
+    if self.request.get('current_game'):
+      game = models.Hangout.peek_current_game(hangout_id)
+      if not game:
+        self.render_jsonp(
+            {'status': 'ERROR',
+             'message': "Game for hangout %s not found" % (hangout_id,)})
+        return
+    try:
+      limit = min(int(self.request.get('limit') or 20), 100)
+    except ValueError:
+      limit = 20
+    if self.request.get('leaderboard'):
+      leaders = models.RoundRecord.leaderboard(hangout_id, limit, game=game)
+      self.render_jsonp(
+          {'status': 'OK',
+           'leaderboard': [{'plus_id': plus_id, 'points': points}
+                           for plus_id, points in leaders]})
+      return
+    cursor = None
+    if self.request.get('cursor'):
+      try:
+        cursor = query.Cursor.from_websafe_string(self.request.get('cursor'))
+      except (datastore_errors.BadValueError, TypeError, ValueError):
+        self.response.set_status(400)
+        self.render_jsonp(
+            {'status': 'ERROR',
+             'message': "Badly formed cursor."})
+        return
+    records, next_cursor, more = models.RoundRecord.history(
+        hangout_id, limit, cursor=cursor, game=game)
+    rounds = []
+    for record in records:
+      rdict = {'game_id': record.game_id, 'round': record.round_num}
+      rdict.update(record.data)
+      rounds.append(rdict)
+    self.render_jsonp(
+        {'status': 'OK', 'rounds': rounds,
+         'cursor': next_cursor.to_websafe_string() if more else None})
+
+
+class StateHandler(BaseHandler):
+  """ Returns the state of the hangout's current game, for clients to resync
+  from (e.g. after missing a channel message).  With since=<version>, only
+  the changes since that version are returned, if the server still has it
+  (otherwise the full state is).  See gamestate.py.
+  """
+
+  def get(self):
+    hangout_id = self.request.get('hangout_id')
+    if not hangout_id:
+      self._render(
+          {'status': 'ERROR',
+           'message': "Hangout ID not given."})
+      return
+    try:
+      since = int(self.request.get('since'))
+    except ValueError:
+      since = None
+    state = gamestate.get(hangout_id, since)
+    if state is None:
+      self._render(
+          {'status': 'ERROR',
+           'message': "Game for hangout %s not found" % (hangout_id,)})
+      return
+    state['status'] = 'OK'
+    self._render(state)
+
+  def _render(self, response):
+    if 'callback' in self.request.GET:
+      self.render_jsonp(response)
+    else:
+      self.render_json(response)
+
+
+class SpectateHandler(StateHandler):
+  """ Lets a viewer follow the hangout's current game without joining it:
+  returns the public messages of the game's spectator stream from sequence
+  number 'since' on (see spectators.py), and the 'seq' to ask for next time.
+  If the game isn't the one the viewer was following ('game_id'), or the
+  viewer has fallen too far behind, the 'full' state of the game is returned
+  too, to resync from.  This makes no datastore writes, and the reads are
+  served from memcache.
+  """
+
+  def get(self):
+    hangout_id = self.request.get('hangout_id')
+    if not hangout_id:
+      self._render(
+          {'status': 'ERROR',
+           'message': "Hangout ID not given."})
+      return
+    try:
+      since = int(self.request.get('since'))
+    except ValueError:
+      since = None
+    snapshot = gamestate.current(hangout_id)
+    if snapshot is None:
+      self._render(
+          {'status': 'ERROR',
+           'message': "Game for hangout %s not found" % (hangout_id,)})
+      return
+    game_id = snapshot['game_id']
+    if self.request.get('game_id') != str(game_id):
+      since = None
+    messages, seq, complete = spectators.read(hangout_id, game_id, since)
+    response = {'status': 'OK', 'game_id': game_id, 'seq': seq,
+                'messages': messages}
+    if since is None or not complete:
+      # (the state is read after the stream's position, so it may already
+      # reflect some of the messages that follow.)
+      response['full'] = gamestate.current(hangout_id) or snapshot
+      response['messages'] = []
+    self._render(response)
+
+
+class LeaderboardHandler(BaseHandler):
+  """ Return the top players of a hangout's leaderboard, or of the global one
+  if no hangout is given.
+  """
+
+  def get(self):
+    hangout_id = self.request.get('hangout_id')
+    if hangout_id:
+      board = leaderboard.hangout_board(hangout_id)
+    else:
+      board = leaderboard.GLOBAL_BOARD
+    try:
+      limit = min(int(self.request.get('limit') or 10),
+                  config.LEADERBOARD_CACHED)
+    except ValueError:
+      limit = 10
+    leaders = leaderboard.top(board, limit)
+    response = {'status': 'OK', 'board': board,
+                'leaderboard': [{'plus_id': plus_id, 'points': points}
+                                for plus_id, points in leaders or []]}
+    if leaders is None:
+      # not cached; it's being rebuilt (see leaderboard.py).
+      response['rebuilding'] = True
+    self.render_jsonp(response)
+
+
+class RebuildProgressHandler(BaseHandler):
+  """ Admin handler that checks the round progress counters kept on a hangout's
+  current game against its participants, and repairs them if they differ.
+  """
+
+  def get(self):
+    hangout_id = self.request.get('hangout_id')
+    if not hangout_id:
+      self.render_jsonp(
+          {'status': 'ERROR',
+           'message': "Hangout ID not given."})
+      return
+
+    def _tx():
+      hangout = models.Hangout.get_by_id(hangout_id)
+      if not hangout or not hangout.current_game:
+        return None, None
+      game = hangout.current_game.get()
+      changed = game.rebuild_progress()
+      if game.progress_version != models.PROGRESS_VERSION:
+        game.progress_version = models.PROGRESS_VERSION
+        changed = True
+      if changed:
+        game.version += 1
+        game.put()
+      return game, changed
+    game, changed = model.transaction(_tx)
+    if changed:
+      # (only once the change has committed.)
+      gamestate.invalidate(hangout_id, game.version)
+    if game is None:
+      self.render_jsonp(
+          {'status': 'ERROR',
+           'message': "Game for hangout %s not found" % (hangout_id,)})
+    else:
+      self.render_jsonp({'status': 'OK', 'repaired': changed})
+
+
+class RefreshChannelsHandler(BaseHandler):
+  """ Admin (cron) handler that refreshes the channel tokens that are about to
+  expire.
+  """
+
+  def get(self):
+    refreshed = channels.refresh_expiring()
+    self.render_jsonp({'status': 'OK', 'refreshed': refreshed})
+
+
+def _record_presence(client_id, connected):
+  session = channels.mark_presence(client_id, connected)
+  if session:
+    # the participants are updated in batches (see states.update_presence).
+    states.schedule_presence_update(session.hangout_id)
+
+
+class ChannelPresenceHandler(BaseHandler):
+  """ Receives the channel_presence notifications (a POST to
+  /_ah/channel/connected/ or /_ah/channel/disconnected/), records them on
+  the player's channel session, and schedules the update of the player's
+  activity in the current game.
+  """
+
+  def post(self, presence):
+    _record_presence(self.request.get('from'), presence == 'connected')
+
+
+class StreamHandler(BaseHandler):
+  """ The Server-Sent Events stream of a client's channel messages, when
+  running with the local realtime gateway (see gateway.py and localserver.py)
+  rather than the Channel API.  Opening and closing the stream count as the
+  channel's presence notifications.
+  """
+
+  def get(self):
+    gw = gateway.get_gateway()
+    if not isinstance(gw, gateway.LocalGateway):
+      self.abort(404)
+    conn = gw.connect(self.request.get('token'))
+    if not conn:
+      self.abort(403)
+    _record_presence(conn.client_id, True)
+    self.response.headers['Content-Type'] = 'text/event-stream'
+    self.response.headers['Cache-Control'] = 'no-cache'
+    self.response.headers['Vary'] = 'Accept-Encoding'
+    stream = self._stream(gw, conn)
+    if _accepts_gzip(self.request.headers.get('Accept-Encoding', '')):
+      self.response.headers['Content-Encoding'] = 'gzip'
+      stream = gateway.gzip_chunks(stream)
+    self.response.app_iter = stream
+
+  def _stream(self, gw, conn):
+    try:
+      for chunk in conn.events():
+        yield chunk
+    finally:
+      # unless the client has already reconnected.
+      if gw.disconnect(conn):
+        _record_presence(conn.client_id, False)
+
+
+class RpcStatsHandler(BaseHandler):
+  """ Admin handler that shows this instance's per-endpoint API call stats
+  (see rpcstats.py), and its recent broadcasts.  With reset=1, the endpoint
+  stats are cleared after being shown.
+  """
+
+  def get(self):
+    stats = {'status': 'OK',
+             'endpoints': rpcstats.endpoint_stats(),
+             'broadcasts': broadcast.stats()}
+    gw = gateway.get_gateway()
+    if isinstance(gw, gateway.LocalGateway):
+      stats['gateway'] = gw.stats()
+    if self.request.get('reset'):
+      rpcstats.reset()
+    self.render_json(stats)
+
+
+class SweepTimeoutsHandler(BaseHandler):
+  """ Admin (cron) handler that queues the timeout of the rounds whose deadline
+  has passed, in case their deadline tasks were lost.
+  """
+
+  def get(self):
+    queued = states.sweep_timeouts()
+    self.render_jsonp({'status': 'OK', 'queued': queued})
 
 
 # ------------------------------------------
-# The following two handlers make use of the GameState classes (see
-# states.py), with the state transition logic pushed to the state classes.
+# The following handlers make use of the GameEngine (see states.py), through
+# the per-hangout action queue (see actionqueue.py), with the
+# state transition logic declared in the transition table there.
 
 
 class VoteHandler(BaseHandler):
@@ -163,7 +688,7 @@ class VoteHandler(BaseHandler):
           {'status': 'ERROR',
            'message': "Hangout ID not given."})
       return
-    game = models.Hangout.get_current_game(hangout_id)
+    game = models.Hangout.peek_current_game(hangout_id)
     if not game:
       self.render_jsonp(
           {'status': 'ERROR',
@@ -187,21 +712,15 @@ class VoteHandler(BaseHandler):
       self.render_jsonp(
           {'status': 'ERROR', 'message': "Voting data incomplete"})
       return
-    # create a 'voting' game state.
-    gs = states.GameStateFactory.get_game_state(self.STATE, hangout_id)
-    # logging.info("about to attempt state transition")
-    # the 'None' arg indicates that it's okay to make any valid transition based
-    # on the given action ('vote')
-    res1 = gs.try_transition(
-        None, action=self.VOTE_ACTION, plus_id=plus_id,
-        card_id=card_id, handler=self)
+    # make the transition for the given action ('vote'), then any internal
+    # transition it enables (to 'scores'), all in one transaction (shared
+    # with any concurrent actions for the hangout).
+    res1, res2 = actionqueue.submit(
+        hangout_id, self.VOTE_ACTION, plus_id=plus_id, card_id=card_id,
+        handler=self)
     logging.info(
-        "result of try_transition on action %s: %s", 
-        self.VOTE_ACTION, res1)
-    # now, see if we can do internal transition to 'scores'. (no action)
-    res2 = gs.try_transition('scores', plus_id=plus_id,
-                             card_id=card_id, handler=self)
-    logging.info("result of try_transition to 'scores': %s", res2)
+        "result of action %s: %s; result of internal transitions: %s",
+        self.VOTE_ACTION, res1, res2)
     if res1 == False or res2 == False:
       # if False, then there was some issue; return the response we have
       # accumulated while processing the transition, which will give error info.
@@ -219,14 +738,6 @@ class SelectCardHandler(BaseHandler):
   SELECT_ACTION = 'select_card'
   STATE = 'start_round'  # the state that this handler covers
 
-  def _broadcast_selected_cards(self, game):
-    participants = game.participants()
-    selected = [p.selected_card for p in participants]
-    random.shuffle(selected)
-    msg = {'selected_cards': selected, 'game_id': game.key.id(),
-           'round': game.current_round}
-    game.message_all_participants(simplejson.dumps(msg))
-
   def get(self):
 
     hangout_id = self.request.get('hangout_id')
@@ -235,7 +746,7 @@ class SelectCardHandler(BaseHandler):
           {'status': 'ERROR',
            'message': "Hangout ID not given."})
       return
-    game = models.Hangout.get_current_game(hangout_id)
+    game = models.Hangout.peek_current_game(hangout_id)
     if not game:
       self.render_jsonp(
           {'status': 'ERROR',
@@ -262,38 +773,266 @@ class SelectCardHandler(BaseHandler):
           {'status': 'ERROR',
            'message': "Card number is not an integer"})
       return
-    gs = states.GameStateFactory.get_game_state(self.STATE, hangout_id)
-    # logging.info("about to attempt state transition")
-    # the 'None' arg indicates that it's okay to make any valid transition based
-    # on the given action ('select_card')
-    selected_p = gs.try_transition(
-        None, action=self.SELECT_ACTION, plus_id=plus_id, card_num=card_number,
+    # make the transition for the given action ('select_card'), then any
+    # internal transition it enables (to 'voting'), all in one transaction
+    # (shared with any concurrent actions for the hangout).
+    selected_p, voting_p = actionqueue.submit(
+        hangout_id, self.SELECT_ACTION, plus_id=plus_id, card_num=card_number,
         handler=self)
     logging.info(
-        "result of try_transition with action %s: %s",
-        self.SELECT_ACTION, selected_p)
-    # now, see if we can do internal transition to 'voting'. (no action)
-    voting_p = gs.try_transition(
-        'voting', plus_id=plus_id, card_num=card_number, handler=self)
-    logging.info("result of try_transition to 'voting': %s", voting_p)
+        "result of action %s: %s; result of internal transitions: %s",
+        self.SELECT_ACTION, selected_p, voting_p)
 
     if selected_p == False or voting_p == False:
       # if False, then there was some issue; return the response we have
       # accumulated while processing the transition, which will give error info.
       self.render_jresp()
     else:  # no errors
-      if voting_p:  # if transition to voting
-        # broadcast the set of selected cards to everyone
-        self._broadcast_selected_cards(game)
+      # (if this was the last selection, the transition to voting has
+      # broadcast the set of selected cards to everyone)
       self.accumulate_response({'status': 'OK', 'message': card_number})
       self.render_jresp()
 
+
+class StartGameHandler(BaseHandler):
+  """ Start the first round of the hangout's current game, which must be in
+  the 'new' state and have enough (config.MIN_PLAYERS) active players.
+  """
+
+  START_ACTION = 'start_game'
+
+  def get(self):
+    hangout_id = self.request.get('hangout_id')
+    if not hangout_id:
+      self.render_jsonp(
+          {'status': 'ERROR',
+           'message': "Hangout ID not given."})
+      return
+    started_p, _ = actionqueue.submit(
+        hangout_id, self.START_ACTION, handler=self)
+    logging.info(
+        "result of action %s: %s", self.START_ACTION, started_p)
+    if started_p == False:
+      self.render_jresp()
+    elif started_p is None:
+      self.render_jsonp(
+          {'status': 'ERROR',
+           'message': "Need at least %s players to start the game." % (
+               config.MIN_PLAYERS,)})
+    else:
+      self.render_jsonp({'status': 'OK'})
+
+
+class _CommandResult(object):
+  """ Collects the response to one command of a batch.  It stands in for the
+  request handler as the 'handler' of a game action, to receive its error
+  info.
+  """
+
+  def __init__(self):
+    self.resp = {}
+
+  def accumulate_response(self, rdict):
+    self.resp.update(rdict)
+
+
+def _error(message):
+  return {'status': 'ERROR', 'message': message}
+
+
+def _is_id(value):
+  """Whether the value (from a json request) can be a hangout or plus id."""
+  return isinstance(value, basestring) and bool(value)
+
+
+class CommandsHandler(BaseHandler):
+  """ Runs a batch of commands for one player, POSTed as json, and returns
+  the result of each in one json response, to save clients on slow links a
+  round trip per command.  The request looks like:
+    {"hangout_id": "123", "plus_id": "p111",
+     "commands": [{"cmd": "join", "inline_text": true},
+                  {"cmd": "select_card", "card_num": 31},
+                  {"cmd": "state"}]}
+  and the response has a "results" list, with one entry (a dict with its own
+  "status") per command.  The commands run in three phases, whatever their
+  order in the batch: first joining the game; then the game actions
+  (start_game, select_card and vote), which are applied together in one
+  transaction, against one snapshot of the game; and then the reads (state,
+  cards and card_text), which see the outcome of the actions.
+  """
+
+  ACTIONS = ('start_game', 'select_card', 'vote')
+  READS = ('state', 'cards', 'card_text')
+
+  def post(self):
+    try:
+      request = simplejson.loads(self.request.body)
+      hangout_id = request['hangout_id']
+      plus_id = request.get('plus_id')
+      commands = list(request['commands'])
+    except (ValueError, KeyError, TypeError):
+      self.response.set_status(400)
+      self.render_json(_error("Badly formed command batch."))
+      return
+    if not _is_id(hangout_id) or not (plus_id is None or _is_id(plus_id)):
+      self.response.set_status(400)
+      self.render_json(_error("Hangout and plus IDs must be strings."))
+      return
+    if len(commands) > config.MAX_COMMANDS:
+      self.render_json(_error(
+          "At most %s commands per batch." % (config.MAX_COMMANDS,)))
+      return
+    results = [None] * len(commands)
+    actions = []  # (index, action, kwargs)
+    reads = []  # (index, command)
+    for i, command in enumerate(commands):
+      cmd = command.get('cmd') if isinstance(command, dict) else None
+      if cmd != 'join' and cmd not in self.ACTIONS + self.READS:
+        results[i] = _error("Unknown command %s" % (cmd,))
+      elif cmd not in ('cards', 'card_text') and not plus_id:
+        results[i] = _error("Plus ID not given.")
+      elif cmd == 'join':
+        results[i] = self._join(hangout_id, plus_id, command)
+      elif cmd in self.ACTIONS:
+        kwargs = self._action_args(cmd, plus_id, command)
+        if kwargs is None:
+          results[i] = _error("Card number is not an integer")
+        else:
+          actions.append((i, cmd, kwargs))
+      else:
+        reads.append((i, command))
+    if actions:
+      action_results = actionqueue.submit_all(
+          hangout_id, [(action, action_kwargs)
+                       for _, action, action_kwargs in actions])
+      for (i, cmd, kwargs), res in zip(actions, action_results):
+        results[i] = self._action_result(cmd, kwargs['handler'], res)
+    for i, command in reads:
+      results[i] = getattr(self, '_' + command['cmd'])(
+          hangout_id, plus_id, command)
+    self.render_json({'status': 'OK', 'results': results})
+
+  def _join(self, hangout_id, plus_id, command):
+    cached_version = None
+    if command.get('inline_text'):
+      cached_version = command.get('card_pack_version') or ''
+    game, participants = _join(hangout_id, [(plus_id, cached_version)],
+                               _wire_format(command.get('wire')))
+    result = {
+        'status': 'OK',
+        'game_id': game.key.id(),
+        'card_pack': game.card_pack,
+        'card_pack_version': game.card_pack_version,
+    }
+    result.update(_player_info(game, participants[0], game.pack()))
+    return result
+
+  def _action_args(self, cmd, plus_id, command):
+    kwargs = {'handler': _CommandResult()}
+    if cmd == 'start_game':
+      return kwargs
+    try:
+      card_num = int(command.get('card_num'))
+    except (TypeError, ValueError):
+      return None
+    kwargs['plus_id'] = plus_id
+    if cmd == 'select_card':
+      kwargs['card_num'] = card_num
+    else:
+      kwargs['card_id'] = card_num
+    return kwargs
+
+  def _action_result(self, cmd, result, res):
+    res1, res2 = res
+    logging.info(
+        "result of action %s: %s; result of internal transitions: %s",
+        cmd, res1, res2)
+    if res1 == False or res2 == False:
+      return result.resp or _error("Could not %s." % (cmd,))
+    if res1 is None:
+      if cmd == 'start_game':
+        return _error("Need at least %s players to start the game." % (
+            config.MIN_PLAYERS,))
+      return _error("Can't %s now." % (cmd,))
+    return {'status': 'OK'}
+
+  def _state(self, hangout_id, plus_id, command):
+    game = models.Hangout.peek_current_game(hangout_id)
+    if not game:
+      return _error("Game for hangout %s not found" % (hangout_id,))
+    participant = models.Participant.get_by_id(plus_id, parent=game.key)
+    return {
+        'status': 'OK',
+        'game_id': game.key.id(),
+        'state': game.state,
+        'round': game.current_round,
+        'current_question': game.current_question,
+        'players': game.players,
+        'selected': game.selected,
+        'voted': game.voted,
+        'cards': participant and participant.cards,
+        'selected_card': participant and participant.selected_card,
+    }
+
+  def _cards(self, hangout_id, plus_id, command):
+    pack = cards.get_pack(command.get('pack'))
+    if not pack:
+      return _error('Unknown card pack %s' % (command.get('pack'),))
+    deck = command.get('deck')
+    if deck not in ('answers', 'questions'):
+      return _error('Unknown deck %s' % (deck,))
+    result = {'status': 'OK', 'pack': pack.name,
+              'card_pack_version': pack.version, 'deck': deck}
+    # like an If-None-Match, the client can give the version it has cached.
+    if command.get('card_pack_version') == pack.version:
+      result['not_modified'] = True
+    else:
+      result['cards'] = getattr(pack, deck)
+    return result
+
+  def _card_text(self, hangout_id, plus_id, command):
+    pack = cards.get_pack(command.get('pack'))
+    if not pack:
+      return _error('Unknown card pack %s' % (command.get('pack'),))
+    deck = command.get('deck')
+    if deck not in ('answers', 'questions'):
+      return _error('Unknown deck %s' % (deck,))
+    # either a list of card numbers, or a string as for /api/card_text.
+    ids = command.get('ids')
+    if isinstance(ids, basestring):
+      ids = cards.parse_ids(ids)
+    elif not isinstance(ids, list) or len(ids) > cards.MAX_IDS_PER_LOOKUP or (
+        not all(isinstance(i, int) for i in ids)):
+      ids = None
+    if ids is None:
+      return _error('Card ids not properly specified (at most %s).' % (
+          cards.MAX_IDS_PER_LOOKUP,))
+    return {'status': 'OK', 'pack': pack.name,
+            'card_pack_version': pack.version, 'deck': deck,
+            'cards': pack.texts(deck, ids)}
+
 # -------------------------
 
-application = webapp2.WSGIApplication([
+application = rpcstats.RpcStatsMiddleware(webapp2.WSGIApplication([
     ('/api/join_game', JoinGameHandler),
+    ('/api/bulk_join', BulkJoinHandler),
+    ('/api/leave_game', LeaveGameHandler),
     ('/api/vote', VoteHandler),
     ('/api/cards', CardMappingHandler),
+    ('/api/card_text', CardTextHandler),
+    ('/api/select_pack', SelectPackHandler),
     ('/api/select_card', SelectCardHandler),
+    ('/api/start_game', StartGameHandler),
+    ('/api/commands', CommandsHandler),
     ('/api/send_message', SendMessageHandler),
-], debug=True)
+    ('/api/history', HistoryHandler),
+    ('/api/state', StateHandler),
+    ('/api/spectate', SpectateHandler),
+    ('/api/leaderboard', LeaderboardHandler),
+    ('/admin/rebuild_progress', RebuildProgressHandler),
+    ('/admin/sweep_timeouts', SweepTimeoutsHandler),
+    ('/admin/refresh_channels', RefreshChannelsHandler),
+    (r'/_ah/channel/(connected|disconnected)/', ChannelPresenceHandler),
+    ('/api/stream', StreamHandler),
+    ('/admin/rpc_stats', RpcStatsHandler),
+], debug=True))
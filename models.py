@@ -1,15 +1,76 @@
+import calendar
+import hashlib
 import random
 import datetime
 import logging
 
-from google.appengine.api import channel
 from ndb import model
 
+import broadcast
 import cards
 import config
 
+try:
+  import json as simplejson
+except ImportError:
+  from django.utils import simplejson
+
 GAME_STATES = ['new', 'start_round', 'voting', 'scores']
 
+# the version of the round progress kept on each Game (see
+# Game.progress_version).
+PROGRESS_VERSION = 1
+
+# the rounds of the Feistel network that permutes the decks.
+DECK_ROUNDS = 4
+
+
+def _deck_round(seed, round_num, half, mask):
+  digest = hashlib.md5('%d|%d|%d' % (seed, round_num, half)).digest()
+  return int(digest[:8].encode('hex'), 16) & mask
+
+
+def _deck_card(seed, size, position):
+  """Returns the card at the given position of a deck of the given size,
+  shuffled as determined by seed, without building the whole deck: the deck
+  order is a keyed (Feistel) permutation of the positions, walked until it
+  lands within the deck, so each card costs a few hashes, whatever the size
+  of the deck.
+  """
+  half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+  mask = (1 << half_bits) - 1
+  card = position
+  while True:
+    left, right = card >> half_bits, card & mask
+    for round_num in range(DECK_ROUNDS):
+      left, right = right, left ^ _deck_round(seed, round_num, right, mask)
+    card = (left << half_bits) | right
+    if card < size:
+      return card
+
+
+class CompactJsonProperty(model.BlobProperty):
+  """An unindexed property holding a json-encodable value, stored as
+  compressed, whitespace-free json.
+  """
+
+  def __init__(self, name=None, **kwds):
+    kwds.setdefault('compressed', True)
+    super(CompactJsonProperty, self).__init__(name, **kwds)
+
+  def _to_base_type(self, value):
+    return simplejson.dumps(value, separators=(',', ':'))
+
+  def _from_base_type(self, value):
+    return simplejson.loads(value)
+
+
+def timeout_bucket_for(when):
+  """The timeout index bucket of the given datetime: the number of whole
+  TIMEOUT_BUCKET_SECONDS periods since the epoch.
+  """
+  return (calendar.timegm(when.timetuple()) //
+          config.TIMEOUT_BUCKET_SECONDS)
 
 
 class Hangout(model.Model):
@@ -18,73 +79,142 @@ class Hangout(model.Model):
   """
 
   current_game = model.KeyProperty()
+  # the card pack used for the hangout's games (takes effect with the next
+  # new game).
+  card_pack = model.StringProperty(default=cards.DEFAULT_PACK, indexed=False)
 
   @property
   def hangout_id(self):
     return self.key.name()
 
   @classmethod
-  def get_current_game(cls, hangout_id):
-    """Retrieves the current game, or creates one if none exists."""
+  def _load_current_game(cls, hangout_id):
+    """Get the hangout and its current game, creating them if they don't
+    exist.  Returns a (hangout, game, created) tuple; if created, the caller
+    is responsible for putting the hangout and the game.
+    """
+    created = False
+    hangout = cls.get_by_id(hangout_id)
+    if not hangout:
+      hangout = cls(id=hangout_id)
+      created = True
+    if hangout.current_game:
+      game = hangout.current_game.get()
+    else:
+      game = Game.new_game(hangout)
+      game.put()
+      hangout.current_game = game.key
+      created = True
+    return hangout, game, created
+
+  @classmethod
+  def peek_current_game(cls, hangout_id):
+    """Retrieves the current game for reading, without a transaction (and
+    without creating one): the hangout and game are read through ndb's
+    in-context cache and memcache.  Returns None if there is no current game.
+
+    The result may lag behind a concurrent transaction, so it's only fit for
+    pre-checks and views; the transitions re-check the state in theirs.  If
+    the cached hangout still points at a game that has ended, the hangout is
+    re-read from the datastore, so a new game isn't missed for long.
+    """
+    hangout = cls.get_by_id(hangout_id)
+    if not hangout or not hangout.current_game:
+      return None
+    game = hangout.current_game.get()
+    if game and game.end_time:
+      hangout = cls.get_by_id(hangout_id, use_cache=False, use_memcache=False)
+      game = hangout.current_game.get(use_cache=False, use_memcache=False)
+    return game
+
+  @classmethod
+  def join_current_game(cls, hangout_id, joins, sessions, wire_format=None):
+    """Seat players in the hangout's current game (creating it if need be),
+    and deal the hands of those who don't have one, in a single transaction
+    with a single put.  joins is a list of (plus_id, cached_version) pairs:
+    cached_version is None if the player's client didn't ask for inline card
+    texts, and otherwise the version of the card pack it has cached (if any),
+    which determines whether it gets them.  sessions is a dict of the
+    players' channel sessions, by plus id (see channels.get_sessions).  If
+    wire_format is given, the players' clients get their messages in that
+    format (see wire.py).
+    Returns the game and the list of participants, in the order of joins.
+    """
 
     def _tx():
-      dirty = False
-      hangout = cls.get_by_id(hangout_id)
-      if not hangout:
-        hangout = cls(id=hangout_id)
-        dirty = True
-      if hangout.current_game:
-        game = hangout.current_game.get()
-      else:
-        game = Game.new_game(hangout)
-        game.put()
-        hangout.current_game = game.key
-        dirty = True
-      if dirty:
-        model.put_multi([hangout, game])
-      return game
+      hangout, game, created = cls._load_current_game(hangout_id)
+      plus_ids = []
+      for plus_id, _ in joins:
+        if plus_id not in plus_ids:
+          plus_ids.append(plus_id)
+      fetched = model.get_multi(
+          [model.Key(Participant, plus_id, parent=game.key)
+           for plus_id in plus_ids])
+      seated = dict(zip(plus_ids, fetched))
+      for plus_id, cached_version in joins:
+        participant = seated[plus_id]
+        if not participant:
+          participant = Participant(id=plus_id, parent=game.key)
+          seated[plus_id] = participant
+        participant.use_session(sessions[plus_id])
+        if not participant.playing:
+          participant.clear_stale_progress(game)
+        participant.playing = True
+        if cached_version is not None:
+          participant.inline_card_text = (
+              cached_version != game.card_pack_version)
+        if wire_format is not None:
+          participant.wire_format = wire_format
+        game.add_player(plus_id)
+      participants = [seated[plus_id] for plus_id in plus_ids]
+      game.deal_hands(participants)
+      game.version += 1
+      entities = [game] + participants
+      if created:
+        entities.append(hangout)
+      model.put_multi(entities)
+      return game, [seated[plus_id] for plus_id, _ in joins]
     return model.transaction(_tx)
 
-  @classmethod
-  def start_new_game(cls, hangout_id, old_participants):
+  def start_new_game(self, current_game, old_participants):
     """If there is a current game, set its end time.  Then create a new game
     and set it as the current hangout game, using the participant list of the
-    previous game. Returns the new game.
+    previous game. Returns the new game and its participants; the caller is
+    responsible for putting the hangout, both games and the new participants.
     """
-    hangout = cls.get_by_id(hangout_id)
-    if not hangout:  # TODO: should this be an error instead?
-      hangout = cls(id=hangout_id)
-    if hangout.current_game:
-      current_game = hangout.current_game.get()
+    if current_game:
       current_game.end_time = datetime.datetime.now()
-      # get the current active participants
-      # TODO: do we need to set these to inactive?  don't think so,
-      # since parent game will no longer be current, and we retrieve by parent
-      # game.
-      # old_participants = current_game.participants()
-    new_game = Game.new_game(hangout)
+      current_game.clear_timeout()
+      # TODO: do we need to set the old participants to inactive?  don't think
+      # so, since parent game will no longer be current, and we retrieve by
+      # parent game.
+    new_game = Game.new_game(self)
+    if current_game:
+      new_game.version = current_game.version + 1
+      new_game.slots = list(current_game.slots)
     new_game.put() # save now to generate key
     # associate new participant objects, using plus_id of the old obj,
     # with the new game.
     new_participants = []
     for p in old_participants:
       newp = Participant(id=p.plus_id, parent=new_game.key)
-      # keep the same channel id and token.
-      # TODO - are there any issues in doing this?
-      # (channel id is based on participant key from original game, but thus
-      # far we don't ever need to reconstruct the keys).
+      # keep the same channel id and token: the player's channel belongs to
+      # the hangout, not the game (see channels.py).  Its token is refreshed
+      # by the channel sessions, or when the player rejoins.
       newp.channel_id = p.channel_id
       newp.channel_token = p.channel_token
       newp.hangout_score = p.hangout_score
+      newp.inline_card_text = p.inline_card_text
+      newp.wire_format = p.wire_format
       newp.playing = True
       new_participants.append(newp)
     new_game.select_new_question()
     # deal cards to the (copied-over) participants
     new_game.deal_hands(new_participants)
-    hangout.current_game = new_game.key
-    model.put_multi(new_participants)
-    model.put_multi([hangout, current_game, new_game])
-    return new_game
+    for p in new_participants:
+      new_game.add_player(p.plus_id)
+    self.current_game = new_game.key
+    return new_game, new_participants
 
 
 class Game(model.Model):
@@ -93,98 +223,258 @@ class Game(model.Model):
   """
 
   state = model.StringProperty(choices=GAME_STATES, default='new')
-  question_deck = model.IntegerProperty(repeated=True)
-  answer_deck = model.IntegerProperty(repeated=True)
+  # the card pack that the game's card numbers refer to.
+  card_pack = model.StringProperty(default=cards.DEFAULT_PACK, indexed=False)
+  card_pack_version = model.StringProperty(indexed=False)
+  # Each deck is a permutation of the card numbers determined by its seed
+  # (see _deck_card), with a cursor indicating the next card to deal, so
+  # dealing doesn't rewrite the deck.
+  question_seed = model.IntegerProperty(indexed=False)
+  question_count = model.IntegerProperty(indexed=False)
+  question_cursor = model.IntegerProperty(default=0, indexed=False)
+  answer_seed = model.IntegerProperty(indexed=False)
+  answer_count = model.IntegerProperty(indexed=False)
+  answer_cursor = model.IntegerProperty(default=0, indexed=False)
+  # The remaining cards of games created before the seeded decks were used.
+  # These games deal from the front of these lists until they end.
+  question_deck = model.IntegerProperty(repeated=True, indexed=False)
+  answer_deck = model.IntegerProperty(repeated=True, indexed=False)
   current_question = model.IntegerProperty()
-  # pause/timeout logic not yet implemented.
+  # set when the current round step times out with no players left; cleared
+  # when a timeout is next set.
   is_paused = model.BooleanProperty(default=False)
-  timeout_at = model.DateTimeProperty()
+  # when the current round step ('start_round' or 'voting') times out, if it
+  # is timed (see set_timeout).
+  timeout_at = model.DateTimeProperty(indexed=False)
+  # the index bucket of timeout_at, so that the timeout sweep can query for
+  # the expired games without touching the others.
+  timeout_bucket = model.IntegerProperty()
   start_time = model.DateTimeProperty(auto_now_add=True)
   end_time = model.DateTimeProperty()
   current_round = model.IntegerProperty()
+  scored_round = model.IntegerProperty(indexed=False)  # last round scored
+  # Per-round progress, maintained in the same transaction as the actions that
+  # change it, so that the round transition checks don't need to query the
+  # participants.  rebuild_progress() recomputes it from the participants.
+  players = model.StringProperty(repeated=True, indexed=False)  # active
+  selected = model.StringProperty(repeated=True, indexed=False)
+  # the card selected by each of the selected players (in the same order), so
+  # that a voted-for card can be mapped to its player without a query.
+  selected_cards = model.IntegerProperty(repeated=True, indexed=False)
+  voted = model.StringProperty(repeated=True, indexed=False)
+  # the version of the progress fields above that the game was created (or
+  # rebuilt) with; None for games created before they were kept.
+  progress_version = model.IntegerProperty(indexed=False)
+  # incremented with each change to the game, and carried on to the next game
+  # of the hangout, so that clients can tell which state they have seen (see
+  # gamestate.py).
+  version = model.IntegerProperty(default=0, indexed=False)
+  # the plus ids of everyone who has played, in the order they joined: a
+  # player's index is their slot, which identifies them in the compact wire
+  # formats (see wire.py).  Carried on to the next game of the hangout.
+  slots = model.StringProperty(repeated=True, indexed=False)
 
   @classmethod
   def new_game(cls, hangout):
     """ Create a new game. This includes setting up a new shuffled question and
-    answer deck.  The answer cards are 'dealt' as participant hands when the
-    participants join.
+    answer deck from the hangout's card pack.  The answer cards are 'dealt' as
+    participant hands when the participants join.
     """
-    question_deck = range(len(cards.questions))
-    random.shuffle(question_deck)
-    logging.info("question deck: %s", question_deck)
-    answer_deck = range(len(cards.answers))
-    random.shuffle(answer_deck)
-    logging.info("answer_deck: %s", answer_deck)
+    pack = cards.get_pack(hangout.card_pack)
+    if not pack:
+      logging.warn(
+          "unknown card pack %s for hangout %s; using the default pack",
+          hangout.card_pack, hangout.key)
+      pack = cards.get_pack()
     return cls(
         parent=hangout.key,
         state='new',
         current_round=0,
-        question_deck=question_deck,
-        answer_deck=answer_deck
+        card_pack=pack.name,
+        card_pack_version=pack.version,
+        question_seed=random.getrandbits(62),
+        question_count=len(pack.questions),
+        answer_seed=random.getrandbits(62),
+        answer_count=len(pack.answers),
+        progress_version=PROGRESS_VERSION,
     )
 
+  def _cards_left(self, deck_name):
+    legacy_deck = getattr(self, deck_name + '_deck')
+    if legacy_deck:
+      return len(legacy_deck)
+    if getattr(self, deck_name + '_seed') is None:
+      return 0
+    return (getattr(self, deck_name + '_count') -
+            getattr(self, deck_name + '_cursor'))
+
+  def _draw(self, deck_name, count):
+    """Draw the next count cards from the named deck ('question' or
+    'answer').  Returns fewer cards if the deck runs out.
+    """
+    legacy_deck = getattr(self, deck_name + '_deck')
+    if legacy_deck:
+      drawn = legacy_deck[:count]
+      del legacy_deck[:count]
+      return drawn
+    seed = getattr(self, deck_name + '_seed')
+    if seed is None:
+      return []
+    cursor = getattr(self, deck_name + '_cursor')
+    size = getattr(self, deck_name + '_count')
+    drawn = [_deck_card(seed, size, position)
+             for position in range(cursor, min(cursor + count, size))]
+    setattr(self, deck_name + '_cursor', cursor + len(drawn))
+    return drawn
+
+  def pack(self):
+    """The CardPack that the game's card numbers refer to."""
+    pack = cards.get_pack(self.card_pack)
+    if pack and pack.version != self.card_pack_version:
+      logging.warn("game %s uses version %s of card pack %s, but have %s",
+                   self.key, self.card_pack_version, pack.name, pack.version)
+    return pack
+
   def participants(self):
     return Participant.query(
         Participant.playing == True,
         ancestor=self.key).fetch()
 
+  def all_participants(self):
+    """The game's participants, whether they're playing or not."""
+    return Participant.query(ancestor=self.key).fetch()
+
+  def add_player(self, plus_id):
+    if plus_id not in self.players:
+      self.players.append(plus_id)
+    if plus_id not in self.slots:
+      self.slots.append(plus_id)
+
+  def remove_player(self, plus_id):
+    if plus_id in self.players:
+      self.players.remove(plus_id)
+
+  def record_selection(self, plus_id, card_num):
+    if plus_id not in self.selected:
+      self.selected.append(plus_id)
+      self.selected_cards.append(card_num)
+
+  def selection_owner(self, card_num):
+    """The plus id of the player who selected the given card this round, or
+    None.
+    """
+    if card_num in self.selected_cards:
+      return self.selected[self.selected_cards.index(card_num)]
+    return None
+
+  def record_vote(self, plus_id):
+    if plus_id not in self.voted:
+      self.voted.append(plus_id)
+
+  def all_selected(self):
+    """Whether all active players have selected a card this round."""
+    return not set(self.players).difference(self.selected)
+
+  def all_voted(self):
+    """Whether all active players have voted this round."""
+    return not set(self.players).difference(self.voted)
+
+  def set_timeout(self, seconds):
+    """Time out the current round step in the given number of seconds, and
+    unpause the game.  The caller is responsible for putting the game.
+    """
+    self.timeout_at = (datetime.datetime.now() +
+                       datetime.timedelta(seconds=seconds))
+    self.timeout_bucket = timeout_bucket_for(self.timeout_at)
+    self.is_paused = False
+    return self.timeout_at
+
+  def clear_timeout(self):
+    self.timeout_at = None
+    self.timeout_bucket = None
+
+  def timed_out(self):
+    """Whether the current round step's timeout has passed."""
+    return (not self.is_paused and self.timeout_at is not None and
+            self.timeout_at <= datetime.datetime.now())
+
+  def reset_progress(self):
+    self.selected = []
+    self.selected_cards = []
+    self.voted = []
+
+  def rebuild_progress(self, participants=None):
+    """Recompute the per-round progress from all of the game's participants
+    (playing or not), e.g. to repair it or to set it up for games created
+    before it was maintained.  As when players leave during a round, the
+    selections and votes of the inactive participants are kept, and so are
+    the recorded abstentions of those who timed out without voting.  Returns
+    True if the stored progress was out of date.  The caller is responsible
+    for putting the game.
+    """
+    if participants is None:
+      participants = self.all_participants()
+    players = [p.plus_id for p in participants if p.playing]
+    selected = [p for p in participants if p.selected_card is not None]
+    selections = dict((p.plus_id, p.selected_card) for p in selected)
+    selected = [p.plus_id for p in selected]
+    voted = [p.plus_id for p in participants if p.vote is not None]
+    plus_ids = set(p.plus_id for p in participants)
+    voted.extend(plus_id for plus_id in self.voted
+                 if plus_id in plus_ids and plus_id not in voted)
+    changed = (set(players) != set(self.players) or
+               selections != dict(zip(self.selected, self.selected_cards)) or
+               set(voted) != set(self.voted))
+    if changed:
+      logging.warn(
+          "rebuilt progress for game %s: players %s, selected %s, voted %s",
+          self.key, players, selected, voted)
+      self.players = players
+      self.selected = selected
+      self.selected_cards = [selections[plus_id] for plus_id in selected]
+      self.voted = voted
+    return changed
+
   def message_all_participants(self, message):
     logging.info("in message_all_participants with msg: %s", message)
-    for participant in self.participants():
-      logging.info("sending channel msg to %s", participant.plus_id)
-      channel.send_message(participant.channel_id, message)
+    bcast = broadcast.Broadcast()
+    bcast.add([p.channel_id for p in self.participants()], message)
+    bcast.send()
 
   # TODO: for now, are basically assuming that we have enough answer cards
   # for all participants to get SIZE_OF_HAND of them.  Currently, if this is
   # not true, the latter participants just don't get cards.
   def deal_hands(self, participants):
-    for p in participants:
-      self.deal_hand(p)
-
-  def deal_hand(self, participant):
-    """ Deal a (randomly selected) hand from the game's answer deck.
+    """ Deal a hand to each of the participants who doesn't have one yet, with
+    a single draw from the game's answer deck.  The caller is responsible for
+    putting the participants and the game.
     """
-    deck_size = len(self.answer_deck)
-    if deck_size < config.SIZE_OF_HAND:
+    dealt = [p for p in participants if not p.cards]
+    hands = min(len(dealt),
+                self._cards_left('answer') // config.SIZE_OF_HAND)
+    if hands < len(dealt):
       logging.warn("not enough cards")
-      return None
-    # this case, where the participant already has a hand dealt, 'should' not
-    # actually come up.  (should it be an error if it does?)
-    if participant.cards:
-      return participant.cards
-    participant.cards = []
-    for _ in range(0, config.SIZE_OF_HAND):
-      # note: since the deck is already shuffled, probably don't really need to
-      # select randomly from it...
-      idx = random.randint(0, deck_size-1)
-      card = self.answer_deck[idx]
-      participant.cards.append(card)
-      del self.answer_deck[idx]
-      deck_size -= 1
-    model.put_multi([participant, self])
-    logging.debug(
-        "participant %s got hand %s", participant.plus_id, participant.cards)
-    logging.debug("answer deck is now: %s", self.answer_deck)
-    return participant.cards
+    drawn = self._draw('answer', hands * config.SIZE_OF_HAND)
+    for i, p in enumerate(dealt[:hands]):
+      p.cards = drawn[i * config.SIZE_OF_HAND:(i + 1) * config.SIZE_OF_HAND]
+      logging.debug("participant %s got hand %s", p.plus_id, p.cards)
 
   def select_new_question(self):
-    """ select a question card (randomly) from the game's question deck.
+    """ select the next question card from the game's (shuffled) question
+    deck.  The caller is responsible for putting the game.
     """
-    logging.debug(
-        "in select_new_question with starting qdeck: %s", self.question_deck)
-    # select at random from the question deck (the random selection may be
-    # overkill since deck is shuffled)
-    qnum = random.randint(0, len(self.question_deck)-1)
-    self.current_question = self.question_deck[qnum]
-    # remove selected from the deck
-    del self.question_deck[qnum]
-    logging.info(
-        "current question %s and new deck %s",
-        self.current_question, self.question_deck)
-    self.put()
+    drawn = self._draw('question', 1)
+    if not drawn:
+      logging.warn("no question cards left in game %s", self.key)
+      return None
+    self.current_question = drawn[0]
+    logging.info("current question %s", self.current_question)
+    return self.current_question
 
   def start_new_round(self, participants):
-    """ start a new round of the given game.
+    """ start a new round of the given game.  participants should be all of
+    the game's participants with round state to reset, playing or not.  The
+    caller is responsible for putting the game and the participants.
     """
     # first check that we have not maxed out the number of rounds for this
     # game.
@@ -204,8 +494,7 @@ class Game(model.Model):
       p.vote = None
       p.selected_card = None
       p.score = 0
-    self.put()
-    model.put_multi(participants)
+    self.reset_progress()
 
 
 class Participant(model.Model):
@@ -223,41 +512,38 @@ class Participant(model.Model):
   cards = model.IntegerProperty(repeated=True)
   selected_card = model.IntegerProperty()
   vote = model.KeyProperty()
+  # whether the participant's client wants card texts included in the
+  # messages sent to it, rather than looking them up in the full decks.
+  inline_card_text = model.BooleanProperty(default=False, indexed=False)
+  # the wire format of the messages sent to the participant's client (see
+  # wire.py); None (the default) is json.
+  wire_format = model.StringProperty(indexed=False)
 
   @property
   def plus_id(self):
     """The user's Google+ ID."""
     return self.key.id()
 
-  @classmethod
-  def get_or_create_participant(cls, game_key, plus_id):
-    """ Either return the participant associated with the given plus_is,
-    or create a new participant with that id, and deal them some cards.
-    """
+  def use_session(self, session):
+    """ Use the player's channel session (see channels.py) for messages."""
+    self.channel_id = session.client_id
+    self.channel_token = session.token
 
-    def _tx():
-      game = game_key.get()
-      participant = cls.get_by_id(plus_id, parent=game_key)
-      if not participant:
-        participant = cls(id=plus_id, parent=game_key)
-        participant.channel_id = str(participant.key)
-        participant.channel_token = channel.create_channel(
-            participant.channel_id)
-      participant.playing = True
-      # deal the hand for the participant.
-      # TODO - deal with the case where the player did not get any cards,
-      # indicated if hand is None.
-      hand = game.deal_hand(participant)
-      # if not hand:
-        # react usefully if there were not enough cards for their hand.
-      model.put_multi([participant, game])
-      return participant
-    return model.transaction(_tx)
+  def clear_stale_progress(self, game):
+    """ Clear the card selection and vote left over from a round of the game
+    that the participant wasn't playing in (e.g. before they are made active
+    again).  Those of the current round are kept.
+    """
+    if self.plus_id not in game.selected:
+      self.selected_card = None
+    if self.plus_id not in game.voted:
+      self.vote = None
 
   def select_card(self, card_num):
-    """ select a card from the participant's hand.
+    """ select a card from the participant's hand.  Returns the card, False if
+    a card was already selected, or None if the card isn't in the hand.
     """
-    if self.selected_card:  # if card already selected
+    if self.selected_card is not None:  # if card already selected
       logging.warn(
           "Participant %s has already selected card %s",
           self.plus_id, self.selected_card)
@@ -273,5 +559,78 @@ class Participant(model.Model):
       return None
 
 
+class RoundRecord(model.Model):
+  """ The record of one completed round: the question, who selected which
+  card, who voted for whom, and the points each player got.  A child entity of
+  the Hangout, so that it is written in the same transaction as the scoring,
+  without adding to the Participant entities.  The key names sort in the order
+  the rounds were played (see key_name_for), so a hangout's history is a
+  plain ancestor query in key order.
+  """
 
+  game_id = model.IntegerProperty(indexed=False)
+  round_num = model.IntegerProperty(indexed=False)
+  # {'question': card, 'pack': pack name, 'selections': {plus_id: card},
+  #  'votes': {plus_id: plus_id voted for}, 'points': {plus_id: points}}
+  data = CompactJsonProperty()
 
+  @classmethod
+  def _game_prefix(cls, game):
+    return '%s-%s-' % (game.start_time.strftime('%Y%m%d%H%M%S%f'),
+                       game.key.id())
+
+  @classmethod
+  def key_name_for(cls, game, round_num):
+    return '%s%03d' % (cls._game_prefix(game), round_num)
+
+  @classmethod
+  def for_round(cls, game, participants):
+    """Build (but don't put) the record of the game's current round."""
+    return cls(
+        id=cls.key_name_for(game, game.current_round),
+        parent=game.key.parent(),
+        game_id=game.key.id(),
+        round_num=game.current_round,
+        data={
+            'question': game.current_question,
+            'pack': game.card_pack,
+            'selections': dict((p.plus_id, p.selected_card)
+                               for p in participants
+                               if p.selected_card is not None),
+            'votes': dict((p.plus_id, p.vote.id())
+                          for p in participants if p.vote is not None),
+            'points': dict((p.plus_id, p.score) for p in participants),
+        })
+
+  @classmethod
+  def history(cls, hangout_id, limit=20, cursor=None, game=None):
+    """Fetch a page of the hangout's round records, oldest first, optionally
+    only those of the given game.  Returns a (records, cursor, more) tuple as
+    for Query.fetch_page.
+    """
+    hangout_key = model.Key(Hangout, hangout_id)
+    query = cls.query(ancestor=hangout_key)
+    if game:
+      prefix = cls._game_prefix(game)
+      query = query.filter(
+          cls.key >= model.Key(cls, prefix, parent=hangout_key),
+          cls.key < model.Key(cls, prefix + '~', parent=hangout_key))
+    return query.fetch_page(limit, start_cursor=cursor)
+
+  @classmethod
+  def leaderboard(cls, hangout_id, limit=10, game=None):
+    """Total the points from the hangout's round records (or those of the
+    given game), and return the top (plus_id, points) pairs.
+    """
+    hangout_key = model.Key(Hangout, hangout_id)
+    query = cls.query(ancestor=hangout_key)
+    if game:
+      prefix = cls._game_prefix(game)
+      query = query.filter(
+          cls.key >= model.Key(cls, prefix, parent=hangout_key),
+          cls.key < model.Key(cls, prefix + '~', parent=hangout_key))
+    totals = {}
+    for record in query.iter():
+      for plus_id, points in record.data.get('points', {}).iteritems():
+        totals[plus_id] = totals.get(plus_id, 0) + points
+    return sorted(totals.items(), key=lambda t: (-t[1], t[0]))[:limit]
@@ -0,0 +1,172 @@
+"""Per-request accounting of API calls, and per-endpoint aggregates.
+
+RpcStatsMiddleware wraps the WSGI application.  For each request, it counts
+the API calls made (datastore, memcache, channel, task queue, ...) by service
+and method, with the bytes of their requests and responses, using an apiproxy
+post-call hook, and times the request.  Messages pushed through a gateway
+that doesn't make API calls (see gateway.py) are counted by Broadcast.send
+with count().  The summary of each request is logged, and optionally sent
+back in an X-RPC-Stats response header (config.RPC_STATS_HEADER).  The
+summaries are aggregated per endpoint in memory (per instance), and can be
+seen at /admin/rpc_stats.
+
+The calls are counted in the thread that makes them, so calls made by one
+request on behalf of others (e.g. the leader of an actionqueue tick) are
+counted against it.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+import config
+
+# upper bounds (ms) of the request time histogram buckets; the last bucket is
+# unbounded.
+HISTOGRAM_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+# the number of distinct paths aggregated; the requests for any others (e.g.
+# mistyped urls) are aggregated together.
+MAX_ENDPOINTS = 100
+
+
+class RequestStats(object):
+  """The API calls made while handling one request."""
+
+  def __init__(self, path):
+    self.path = path
+    self.start = time.time()
+    self.wall_ms = None
+    self.calls = collections.defaultdict(int)  # 'service.method' -> count
+    self.bytes = 0
+
+  def record(self, name, size=0, count=1):
+    self.calls[name] += count
+    self.bytes += size
+
+  def finish(self):
+    self.wall_ms = (time.time() - self.start) * 1000
+
+  def summary(self):
+    return '%.1fms %dB %s' % (
+        self.wall_ms, self.bytes,
+        ' '.join('%s=%d' % kv for kv in sorted(self.calls.items())))
+
+
+class EndpointStats(object):
+  """The aggregate of the requests to one endpoint."""
+
+  def __init__(self):
+    self.requests = 0
+    self.wall_ms = 0.0
+    self.bytes = 0
+    self.calls = collections.defaultdict(int)
+    self.histogram = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+
+  def add(self, stats):
+    self.requests += 1
+    self.wall_ms += stats.wall_ms
+    self.bytes += stats.bytes
+    for name, count in stats.calls.iteritems():
+      self.calls[name] += count
+    bucket = 0
+    while (bucket < len(HISTOGRAM_BUCKETS_MS) and
+           stats.wall_ms > HISTOGRAM_BUCKETS_MS[bucket]):
+      bucket += 1
+    self.histogram[bucket] += 1
+
+  def as_dict(self):
+    n = float(self.requests) or 1.0
+    labels = ['<=%d' % ms for ms in HISTOGRAM_BUCKETS_MS]
+    labels.append('>%d' % HISTOGRAM_BUCKETS_MS[-1])
+    return {
+        'requests': self.requests,
+        'mean_ms': round(self.wall_ms / n, 1),
+        'mean_bytes': int(self.bytes / n),
+        'calls_per_request': dict((name, round(count / n, 2))
+                                  for name, count in self.calls.iteritems()),
+        'histogram_ms': dict(zip(labels, self.histogram)),
+    }
+
+
+_local = threading.local()
+_lock = threading.Lock()
+_endpoints = collections.defaultdict(EndpointStats)
+_hooked = None  # the apiproxy that our hook was added to
+
+
+def current():
+  """The stats of the request being handled by this thread, or None."""
+  return getattr(_local, 'stats', None)
+
+
+def count(name, size=0, count=1):
+  """Count calls (of something other than the API) for the current request."""
+  stats = current()
+  if stats:
+    stats.record(name, size, count)
+
+
+def _post_call(service, call, request, response):
+  stats = current()
+  if stats:
+    size = 0
+    try:
+      size = request.ByteSize() + response.ByteSize()
+    except AttributeError:
+      pass
+    stats.record('%s.%s' % (service, call), size)
+
+
+def _install_hook():
+  # (the apiproxy is replaced in tests, e.g. by the testbed.)
+  global _hooked
+  apiproxy = apiproxy_stub_map.apiproxy
+  if _hooked is not apiproxy:
+    with _lock:
+      if _hooked is not apiproxy:
+        apiproxy.GetPostCallHooks().Append('rpcstats', _post_call)
+        _hooked = apiproxy
+
+
+def endpoint_stats():
+  """The aggregated stats of each endpoint, as a dict by path."""
+  with _lock:
+    return dict((path, e.as_dict()) for path, e in _endpoints.iteritems())
+
+
+def reset():
+  with _lock:
+    _endpoints.clear()
+
+
+class RpcStatsMiddleware(object):
+  """WSGI middleware that accounts for the API calls of each request."""
+
+  def __init__(self, app):
+    self.app = app
+
+  def __call__(self, environ, start_response):
+    _install_hook()
+    stats = RequestStats(environ.get('PATH_INFO', ''))
+    _local.stats = stats
+
+    def _start_response(status, headers, exc_info=None):
+      if config.RPC_STATS_HEADER:
+        stats.finish()
+        headers = list(headers) + [('X-RPC-Stats', stats.summary())]
+      return start_response(status, headers, exc_info)
+
+    try:
+      return self.app(environ, _start_response)
+    finally:
+      _local.stats = None
+      stats.finish()
+      logging.info("rpc stats for %s: %s", stats.path, stats.summary())
+      with _lock:
+        path = stats.path
+        if path not in _endpoints and len(_endpoints) >= MAX_ENDPOINTS:
+          path = '(other)'
+        _endpoints[path].add(stats)
@@ -0,0 +1,72 @@
+"""Spectator streams: the public messages of each game, for viewers to follow.
+
+Spectators aren't players: they have no Participant entities or channels, so
+any number of them adds no datastore writes and no sends to a broadcast.
+Instead, the public messages of each transition (selections, the selected
+cards, scores and timeouts, but not the players' hands) are appended, once
+per broadcast, to a stream per game kept in memcache, which spectators poll
+(see /api/spectate).  Each message in a stream has a sequence number, and the
+last SPECTATOR_STREAM_SIZE are kept; a spectator that falls further behind
+resyncs from the game's state snapshot (see gamestate.py).
+"""
+
+import logging
+
+from google.appengine.api import memcache
+
+import config
+
+# the compare-and-set attempts made to append to a stream, before giving up.
+PUBLISH_ATTEMPTS = 5
+
+
+def _stream_key(hangout_id, game_id):
+  return 'spectate:%s:%s' % (hangout_id, game_id)
+
+
+def publish(hangout_id, game_id, messages):
+  """Append the (encoded) messages to the game's spectator stream.  Returns
+  whether they were appended.
+  """
+  if not messages:
+    return True
+  client = memcache.Client()
+  key = _stream_key(hangout_id, game_id)
+  for _ in range(PUBLISH_ATTEMPTS):
+    stream = client.gets(key)
+    if stream is None:
+      seq, kept = 0, []
+    else:
+      seq, kept = stream['next'], stream['messages']
+    for message in messages:
+      kept.append((seq, message))
+      seq += 1
+    new_stream = {'next': seq,
+                  'messages': kept[-config.SPECTATOR_STREAM_SIZE:]}
+    if stream is None:
+      stored = client.add(key, new_stream)
+    else:
+      stored = client.cas(key, new_stream)
+    if stored:
+      return True
+  logging.warn("could not publish %s messages to spectators of game %s/%s",
+               len(messages), hangout_id, game_id)
+  return False
+
+
+def read(hangout_id, game_id, since=None):
+  """Read the game's spectator stream.  Returns a (messages, next, complete)
+  tuple: the messages from sequence number since on, the sequence number to
+  read from next time, and whether those are all the messages since then
+  (rather than some having been dropped, or the stream evicted).  With since
+  None, just the position of the stream is returned.
+  """
+  stream = memcache.get(_stream_key(hangout_id, game_id))
+  if stream is None:
+    # not started yet, or evicted.
+    return [], 0, since is None or since == 0
+  if since is None:
+    return [], stream['next'], True
+  messages = [m for seq, m in stream['messages'] if seq >= since]
+  oldest = stream['messages'][0][0] if stream['messages'] else stream['next']
+  return messages, stream['next'], oldest <= since <= stream['next']
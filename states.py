@@ -1,491 +1,839 @@
+import calendar
+import datetime
+import hashlib
+import random
 from ndb import model
 import logging
 
-from google.appengine.api import channel, memcache
-
+import broadcast
+import channels
 import config
+import gamestate
+import leaderboard
 import models
-
-try:
-  import json as simplejson
-except ImportError:
-  from django.utils import simplejson
+import tasks
+import wire
 
 # logging.getLogger().setLevel(logging.DEBUG)
 
-# This class and its subclasses are an attempt to make the state transition
-# logic used by the app more explicit (but not fully declarative).  This code
-# works; however still playing around with the general approach-- this may
-# not be the final design
-
-# Currently, the card selection state and the voting state are implemented
-# as subclasses.
-# Currently, the transitions are not ambiguous, i.e. there is a
-# non-intersecting set of transition conditions from a state to each of its
-# its next states.
-
-
-class GameState(object):
-  """
-  A base class for the 'game states'. 
-  Each subclass must encode information about the names of the states that it
-  can transition to, how to check that the transition conditions are met for
-  each such next state, and how to make the transition to each next state.
-  Then, the try_transition method tries to transit to a specific next state when
-  specified, and otherwise (if the next state is not specified), transits to
-  the first 'next state' it finds, whose transition conditions are met.
+# The game's state machine is declared in the TRANSITIONS table below: each
+# entry gives the state it applies in, the action that triggers it (or None
+# for an 'internal' transition, taken as soon as its guard holds), a guard
+# evaluated against the game snapshot, the effect that performs it, and the
+# state the game is left in.  The table is compiled once, at import, into a
+# dispatch map keyed by (state, action).  A GameEngine applies one or more
+# actions, and the internal transitions they enable, in a single transaction.
+
+
+class GameSnapshot(object):
+  """A per-request view of a hangout's current game.  The Hangout and its
+  current Game are loaded once, inside the transaction that processes the
+  request, and the state transitions operate on these in-memory entities.
+  The Game's active Participants are only queried if a transition needs all of
+  them; the round progress checks use the counters kept on the Game.
+  Entities modified by a transition are marked dirty, and written back together
+  with a single put_multi by commit().  Channel messages generated by the
+  transitions are collected in the snapshot's broadcast, to be sent after the
+  transaction commits.
   """
 
   def __init__(self, hangout_id):
     self.hangout_id = hangout_id
-    self.next_states = None  # set by subclasses
+    self.hangout = None
+    self.game = None
+    self._participants = None
+    self._fetched = {}  # participants fetched individually, by plus id
+    self._dirty = []
+    self.broadcast = broadcast.Broadcast()
 
-  def _check_transit_conds(self, next_state, **kwargs):
-    """should be implemented by the subclass-- checks whether conditions are met
-    to transition to the given next state.  Should return True if conditions
-    met, False if not.
+  @classmethod
+  def load(cls, hangout_id):
+    snapshot = cls(hangout_id)
+    snapshot.hangout = models.Hangout.get_by_id(hangout_id)
+    if snapshot.hangout and snapshot.hangout.current_game:
+      snapshot.game = snapshot.hangout.current_game.get()
+    if snapshot.game and (
+        snapshot.game.progress_version != models.PROGRESS_VERSION):
+      # games created before the progress (or the selected cards) were kept
+      # on the Game: set it up once, from all their participants.
+      snapshot.game.rebuild_progress()
+      snapshot.game.progress_version = models.PROGRESS_VERSION
+      snapshot.mark_dirty(snapshot.game)
+    return snapshot
+
+  @property
+  def participants(self):
+    """The game's active participants, queried on first use.  The query sees
+    the datastore as of the start of the transaction, so the participants
+    fetched (and possibly changed) since are put in place of their queried
+    copies, and included or left out by whether they're playing now.
     """
-    raise NotImplementedError(
-        "_check_transit_conds() not implemented in %s" % self)
+    if self._participants is None:
+      if self.game:
+        queried = self.game.participants()
+        participants = [self._fetched.get(p.plus_id, p) for p in queried]
+        queried_ids = set(p.plus_id for p in queried)
+        participants.extend(p for plus_id, p in self._fetched.iteritems()
+                            if plus_id not in queried_ids)
+        self._participants = [p for p in participants if p.playing]
+      else:
+        self._participants = []
+    return self._participants
 
-  def _make_transit(self, next_state, **kwargs):
-    """Should be implemented by the subclass-- makes the transition to the
-    specified next state.  Should return True if transition successful, 
-    False if not.
+  def inactive_participants(self):
+    """The game's participants who aren't playing, queried (with those
+    fetched since put in place of their queried copies).
+    """
+    if not self.game:
+      return []
+    participants = dict((p.plus_id, p) for p in self.game.all_participants())
+    participants.update(self._fetched)
+    return [p for p in participants.itervalues() if not p.playing]
+
+  def get_participant(self, plus_id):
+    """Returns the participant with the given plus id, using the loaded
+    participants if possible, and fetching it by key otherwise.
+    """
+    if self._participants is not None:
+      for p in self._participants:
+        if p.plus_id == plus_id:
+          return p
+    if plus_id in self._fetched:
+      return self._fetched[plus_id]
+    if not self.game:
+      return None
+    participant = model.Key(
+        models.Participant, plus_id, parent=self.game.key).get()
+    if participant:
+      self._fetched[plus_id] = participant
+    return participant
+
+  def set_playing(self, participant, playing):
+    """Make the participant an active player in the game, or not, keeping the
+    game's players and the loaded participants in step.
+    """
+    if playing and not participant.playing:
+      participant.clear_stale_progress(self.game)
+    participant.playing = playing
+    self._fetched[participant.plus_id] = participant
+    if playing:
+      self.game.add_player(participant.plus_id)
+    else:
+      self.game.remove_player(participant.plus_id)
+    if self._participants is not None:
+      self._participants = [p for p in self._participants
+                            if p.plus_id != participant.plus_id]
+      if playing:
+        self._participants.append(participant)
+    self.mark_dirty(participant, self.game)
+
+  def send(self, participants, message):
+    """Queue the message dict for the participants, encoded once in each of
+    their clients' wire formats (see wire.py).
     """
-    raise NotImplementedError("make_transit() not implemented in %s" % self)
-
-  def try_transition(self, next_state, **kwargs):
-    """Transition (if conditions are met) to the given next_state if next state
-    arg is set;  otherwise (no specific next_state indicated)
-    to a next state whose transition conditions are met. make_transit should
-    return True if transition made; False, if error while
-    making transition.  try_transition returns None if no transition tried
-    (no conditions met).
+    by_format = {}
+    for p in participants:
+      by_format.setdefault(p.wire_format, []).append(p.channel_id)
+    for wire_format, client_ids in by_format.iteritems():
+      self.broadcast.add(
+          client_ids, wire.encode(message, wire_format, self.game.slots))
+
+  def spectate(self, message):
+    """Queue the (public) message for the current game's spectators too."""
+    self.broadcast.spectate(self.hangout_id, self.game.key.id(), message)
+
+  def mark_dirty(self, *entities):
+    for entity in entities:
+      if not any(entity is e for e in self._dirty):
+        self._dirty.append(entity)
+
+  def start_new_game(self):
+    """Replace the current game with a new one, seated with the current
+    game's active participants.
     """
-    # Note: wrapping the entire transition, including its condition checking,
-    # in a transaction.  This is overkill under many circumstances (so we might
-    # want to change this if there are contention issues), and also takes
-    # advantage of the fact that currently everything we need to operate on
-    # is in the same entity group, but makes the semantics of the
-    # implementation more clear.
+    new_game, new_participants = self.hangout.start_new_game(
+        self.game, self.participants)
+    self.mark_dirty(self.hangout, self.game, new_game, *new_participants)
+    self.game = new_game
+    self._participants = new_participants
+    self._fetched = {}
+    return new_game
 
-    def _tx():
-      res = None
-      if next_state:  # if state specified, try to transit to it
-        if self._check_transit_conds(next_state, **kwargs):
-          res = self._make_transit(next_state, **kwargs)
-      else:
-        for ns in self.next_states:
-          # take the first transition whose conditions are met
-          if self._check_transit_conds(ns, **kwargs):
-            res = self._make_transit(ns, **kwargs)
-            logging.info("finished make_transit with res %s", res)
-            break
-      return res
-    resp = model.transaction(_tx)  # run the transaction
-    return resp
+  def commit(self):
+    """Put the dirty entities.  Returns True if the current game changed."""
+    changed = False
+    for entity in self._dirty:
+      if isinstance(entity, models.Game):
+        entity.version += 1
+        changed = changed or entity is self.game
+    if self._dirty:
+      model.put_multi(self._dirty)
+    self._dirty = []
+    return changed
+
+
+def _report(handler, message):
+  """Add error info to the response being built by the request handler, if
+  there is one (tasks run transitions without a handler).
+  """
+  if handler:
+    handler.accumulate_response({'status': 'ERROR', 'message': message})
 
-  # this key-generation method (for memcache storage) is used by > 1 subclass
-  def _selections_key(self, game_id, curr_round):
-    return "%s:%s:selections" % (game_id, curr_round)
 
+# ----------------------------------------
+# Guards.  Each takes the snapshot and the action's arguments, and returns a
+# boolean.
 
-class GameStateFactory(object):
-  """Generate a GameState subclass according to the given state name."""
 
-  @classmethod
-  def get_game_state(cls, state_name, hangout_id):
-    if state_name == 'voting':
-      return VotingGameState(hangout_id)
-    if state_name == 'start_round':
-      return StartRoundGameState(hangout_id)
-    else:
-      return None
+def all_cards_selected(snapshot, **kwargs):
+  """returns a boolean, indicating whether all active game participants have
+  selected a card for this round.
+  """
+  game = snapshot.game
+  logging.debug("players %s, selected: %s", game.players, game.selected)
+  return bool(game.players) and game.all_selected()
+
+
+def all_votesp(snapshot, **kwargs):
+  """returns a boolean, indicating whether all active game participants have
+  registered a vote. (vote info gets reset at the end of each round).
+  """
+  game = snapshot.game
+  logging.info("players %s, voted: %s", game.players, game.voted)
+  return bool(game.players) and game.all_voted()
+
+
+def enough_players(snapshot, **kwargs):
+  return len(snapshot.game.players) >= config.MIN_PLAYERS
+
+
+def _at_round(snapshot, game_id, round_num):
+  """Whether the game is still the current game, at the given round.  (Used to
+  make the tasks queued for a round idempotent.)
+  """
+  game = snapshot.game
+  if game.key.id() != game_id:
+    logging.info("game %s is no longer current", game_id)
+    return False
+  if game.current_round != round_num:
+    logging.info("game %s has moved on from round %s (round %s)",
+                 game_id, round_num, game.current_round)
+    return False
+  return True
+
+
+def round_not_scored(snapshot, game_id=None, round_num=None, **kwargs):
+  if not _at_round(snapshot, game_id, round_num):
+    return False
+  if snapshot.game.scored_round == round_num:
+    logging.info("round %s of game %s already scored", round_num, game_id)
+    return False
+  return True
+
+
+def round_scored(snapshot, game_id=None, round_num=None, **kwargs):
+  if not _at_round(snapshot, game_id, round_num):
+    return False
+  if snapshot.game.scored_round != round_num:
+    logging.info("round %s of game %s not scored yet", round_num, game_id)
+    return False
+  return True
+
+
+def round_timed_out(snapshot, game_id=None, round_num=None, **kwargs):
+  if not _at_round(snapshot, game_id, round_num):
+    return False
+  if not snapshot.game.timed_out():
+    logging.info("round %s of game %s has not timed out (timeout %s)",
+                 round_num, game_id, snapshot.game.timeout_at)
+    return False
+  return True
+
 
 # ----------------------------------------
+# Effects.  Each takes the snapshot and the action's arguments, modifies the
+# snapshot's entities (marking them dirty) and broadcast, and returns True if
+# successful, False if not.
 
 
-class VotingGameState(GameState):
-  """Encodes information about the 'voting' state.
+def _set_round_timeout(snapshot):
+  """Time out the round step that the game is entering, by queueing a
+  round_timeout task for its deadline.  (Games whose task is lost are found by
+  sweep_timeouts.)
   """
+  game = snapshot.game
+  game.set_timeout(config.ROUND_STEP_TIMEOUT)
+  snapshot.mark_dirty(game)
+  tasks.defer(round_timeout, snapshot.hangout_id, game.key.id(),
+              game.current_round, _countdown=config.ROUND_STEP_TIMEOUT)
 
-  def __init__(self, hangout_id):
-    GameState.__init__(self, hangout_id)
-    self.state_name = 'voting'
-    self.next_states = ['voting', 'scores']
-
-  def _check_transit_conds(self, next_state, **kwargs):
-    """Encodes transition conditions for the 'voting' state to the given next
-    state.
-    Returns a boolean.
-    If the next state is 'voting', and the 'action' argument is 'vote', then it
-    is always okay to transition. (a user can vote more than once as long
-    as the game is still in the 'voting' state; the last vote is retained).
-    If the next state is 'scores', then transition conditions are met if all
-    participants have voted.
-    """
-    game = models.Hangout.get_by_id(self.hangout_id).current_game.get()
-    if next_state == self.state_name:
-      return kwargs['action']  == 'vote'
-    elif next_state == 'scores': # okay to transition if all participants
-        # have voted
-      return self.all_votesp(game.key)
-    else:
-      return False
 
-  def _make_transit(self, next_state, **kwargs):
-    """Perform the transition to the given next state.  Returns a boolean:
-    True if transition was successful, False if not.
-    """
-    if next_state == 'voting':
-      return self._transit_to_voting(**kwargs)
-    elif next_state == 'scores':
-      return self._transit_to_scores(**kwargs)
-    else:
-      return False
+def _resume_if_paused(snapshot):
+  """A player is back in a game that was paused for lack of players; restart
+  the round's clock.
+  """
+  if snapshot.game.is_paused:
+    _set_round_timeout(snapshot)
 
-  def all_votesp(self, game_key):
-    """returns a boolean, indicating whether all active game participants have
-    registered a vote. (vote info gets reset at the end of each round).
-    """
-    participants = models.Participant.query(
-        models.Participant.playing == True,
-        models.Participant.vote == None,
-        ancestor=game_key).fetch()
-    logging.info(
-            "participants who have not voted: %s", 
-            [p.plus_id for p in participants])
-    if participants:
-      return False
-    else:
-      return True
-
-  def _get_pid_from_selcard(self, card_id):
-    """..."""
-
-    # (re)build entire memcache selections list, then return info for
-    # requested card. The participants' selected
-    # cards are for the current round.
-    game = models.Hangout.get_by_id(self.hangout_id).current_game.get()
-    skey = self._selections_key(game.key.id(), game.current_round)
-    selections = {}
-    participants = game.participants()
-    for p in participants:
-      if p.selected_card:
-        selections[p.selected_card] = p.plus_id
-    logging.info("in _get_pid_from_selcard, got selections list %s",
-                 selections)
-    memcache.set(skey, selections)
-    return selections.get(card_id)
-
-  # performed if the action is 'vote', as indicated above in
-  # _check_transit_conds
-  def _transit_to_voting(self, **kwargs):
-    """Transition from the 'voting' state to itself (via the 'vote' action).
-    Once placed, a vote will not be unset from this 'voting' state,
-    though it could be overridden with another vote from the same person
-    before all votes are in (which is okay)
-    """
 
-    handler = kwargs['handler']
+def _selected(result):
+  """Whether the result of Participant.select_card is the selected card
+  (which may be card 0), rather than None or False.
+  """
+  return result is not None and result is not False
 
-    plus_id = kwargs['plus_id']
-    card_id = kwargs['card_id']
-    game = models.Hangout.get_by_id(self.hangout_id).current_game.get()
-    if not game:
-      if handler:
-        handler.accumulate_response(
-            {'status': 'ERROR',
-             'message': "Game for hangout %s not found" % (self.hangout_id,)})
-      return False
-    if not game.state == self.state_name:
-      if handler:
-        handler.accumulate_response(
-            {'status': 'ERROR',
-             'message': (
-                 "Can't vote now, wrong game state %s." % (game.state,))})
-      return False      
-    # try to get the id of the voted-for player based on their selected card
-    # via memcache first.
-    selections = memcache.get(
-        self._selections_key(game.key.id(), game.current_round))
-    if selections:  # if cache hit
-      logging.info("got selections cache hit: %s", selections)
-      pvid = selections.get(card_id)
-      if not pvid:
-        # cache list was present, but not info for that card
-        pvid = self._get_pid_from_selcard(card_id)
-    else:  # cache miss on selections list
-      logging.info("did not get selections cache hit")
-      pvid = self._get_pid_from_selcard(card_id)
-    logging.debug("in _transit_to_voting, with plus id %s and pvid %s",
-                  plus_id, pvid)
-    if not plus_id or not pvid:
-      if handler:
-        handler.accumulate_response(
-            {'status': 'ERROR',
-             'message': 'Voting information not properly specified'})
-      return False
-    if plus_id == pvid:
-      if handler:
-        handler.accumulate_response(
-            {'status': 'ERROR',
-             'message': 'Participants cannot vote for themselves.'})
-      return False
-
-    participant_key = model.Key(models.Participant, plus_id, parent=game.key)
-    participant = participant_key.get()
-    if not participant:
-      if handler:
-        handler.accumulate_response(
-            {'status': 'ERROR',
-             'message': "Could not retrieve indicated participant"})
-      return False
-    # TODO: also check that entity exists for given participant key
-    vpkey = model.Key(models.Participant, pvid, parent=game.key)
-    participant.vote = vpkey
-    participant.put()
-    return True
-
-  # performed if all participants have voted, as indicated above in
-  # _check_transit_conds
-  def _transit_to_scores(self, **kwargs):
-    """Transition from the 'voting' state to the 'scores' state.
-    """
-    logging.debug("in _transit_to_scores")
-    handler = kwargs['handler']
 
-    game = models.Hangout.get_by_id(self.hangout_id).current_game.get()
-    if not game:
-      if handler:
-        handler.accumulate_response(
-            {'status': 'ERROR',
-             'message': "Game for hangout %s not found" % (self.hangout_id,)})
-      return False
-    if game.state != self.state_name:
-      return False  # not in 'voting' state
-    game.state = 'scores'
-    participants = self._calculate_scores(game)
-    game.put()
-    # send out the score info on the channels.
-    # TODO: currently, the scores for this round are only recorded briefly,
-    # as the code below will reset them as part of the setup for the
-    # next round/game.  Might want to change this.
-    # TODO: should the broadcasting part be part of the handler logic or
-    # the state transition logic?
-    self._broadcast_scores(participants, game.key.id(), game.current_round)
-
-    # We can now start a new round.  This resets the card selection and vote
-    # fields.  If we've had N rounds, this is a new game instead.  
-    if game.current_round >= (config.ROUNDS_PER_GAME - 1):
-      # if have reached the limit of rounds for a game,
-      # then start new game using the participants of the current game
-      self.start_new_game(participants)
-      return True
-    else:
-      # otherwise, start new round in the current game
-      logging.info("starting new round.")
-      game.start_new_round(participants)
-      return True
+def start_game(snapshot, **kwargs):
+  """From the 'new' state, start the first round of the game."""
+  game = snapshot.game
+  if game.current_question is None:
+    game.select_new_question()
+  snapshot.mark_dirty(game)
+  _set_round_timeout(snapshot)
+  return True
 
-  def start_new_game(self, participants):
+
+def select_card(snapshot, **kwargs):
+  """From the start_round state, transition to the start_round state, by
+  selecting a card from the player's hand.
+  """
+  logging.info("in select_card")
+  handler = kwargs.get('handler')
+  plus_id = kwargs['plus_id']
+  selected_card = kwargs['card_num']
+  game = snapshot.game
+  logging.debug("using game: %s", game)
+  participant = snapshot.get_participant(plus_id)
+  if not participant:
+    _report(handler, "Could not retrieve indicated participant")
+    return False
+  sres = participant.select_card(selected_card)
+  if not _selected(sres):
+    _report(handler, "could not select card %s from hand" % selected_card)
+    return False
+  game.record_selection(plus_id, selected_card)
+  snapshot.mark_dirty(participant, game)
+  _resume_if_paused(snapshot)
+
+  # broadcast successful selection by player, but don't indicate the
+  # card selected.  (After all have selected, the shuffled set of
+  # selections will be broadcast)
+  message = {'player_selection':
+             {'participant': plus_id,
+              'game_id': game.key.id(),
+              'round': game.current_round}}
+  logging.info("player selection channel msg: %s", message)
+  snapshot.send(snapshot.participants, message)
+  snapshot.spectate(message)
+  return True
+
+
+def begin_voting(snapshot, **kwargs):
+  """From the start_round state, transition to the voting state, once all
+  participants have selected a card.
+  """
+  logging.debug("in begin_voting")
+  game = snapshot.game
+  _set_round_timeout(snapshot)
+  # broadcast the (shuffled) set of selected cards to everyone, with the
+  # card texts for the clients that asked for them.
+  participants = snapshot.participants
+  selected = list(game.selected_cards)
+  random.shuffle(selected)
+  message = {'selected_cards': selected, 'game_id': game.key.id(),
+             'round': game.current_round}
+  plain = [p for p in participants if not p.inline_card_text]
+  inline = [p for p in participants if p.inline_card_text]
+  pack = game.pack()
+  if inline and pack:
+    snapshot.send(
+        inline, dict(message, card_text=pack.texts('answers', selected)))
+  else:
+    plain.extend(inline)
+  snapshot.send(plain, message)
+  snapshot.spectate(message)
+  return True
+
+
+def vote(snapshot, **kwargs):
+  """Transition from the 'voting' state to itself (via the 'vote' action).
+  Once placed, a vote will not be unset from this 'voting' state,
+  though it could be overridden with another vote from the same person
+  before all votes are in (which is okay)
+  """
+  handler = kwargs.get('handler')
+  plus_id = kwargs['plus_id']
+  card_id = kwargs['card_id']
+  game = snapshot.game
+  # get the id of the voted-for player based on their selected card.
+  pvid = game.selection_owner(card_id)
+  logging.debug("in vote, with plus id %s and pvid %s", plus_id, pvid)
+  if not plus_id or not pvid:
+    _report(handler, 'Voting information not properly specified')
+    return False
+  if plus_id == pvid:
+    _report(handler, 'Participants cannot vote for themselves.')
+    return False
+
+  participant = snapshot.get_participant(plus_id)
+  if not participant:
+    _report(handler, "Could not retrieve indicated participant")
+    return False
+  # TODO: also check that entity exists for given participant key
+  vpkey = model.Key(models.Participant, pvid, parent=game.key)
+  participant.vote = vpkey
+  game.record_vote(plus_id)
+  snapshot.mark_dirty(participant, game)
+  _resume_if_paused(snapshot)
+  return True
+
+
+def begin_scoring(snapshot, **kwargs):
+  """Transition from the 'voting' state to the 'scores' state, once all
+  participants have voted, and queue the scoring of the round.
+  """
+  logging.debug("in begin_scoring")
+  game = snapshot.game
+  game.clear_timeout()
+  snapshot.mark_dirty(game)
+  # the scoring, and the setup of the next round or game, are done by
+  # a pipeline of tasks (score_round, then advance_round), so that the last
+  # vote doesn't take longer than any other.  Their guards make them
+  # idempotent: each does nothing unless the game is still at the step it was
+  # queued for.
+  tasks.defer(score_round, snapshot.hangout_id, game.key.id(),
+              game.current_round)
+  return True
+
+
+def _build_votes_dict(participants, voted):
+  """
+  Accumulate the votes for each participant from the other participants
+  for this round (only counting those who voted this round, according to
+  voted, the game's list).
+  """
+  # more idiomatic way to do this?
+  pvotes = {}
+  for p in participants:
+    if p.vote is None or p.plus_id not in voted:
+      continue
+    pid = p.vote.id()
+    pvcount = pvotes.get(pid, 0)
+    pvotes[pid] = pvcount + 1
+  logging.info("in _build_votes_dict, got pvotes: %s", pvotes)
+  return pvotes
+
+
+def _calculate_scores(snapshot):
+  # for all active participants, calculate everyone's scores, based on
+  # yet-to-be-defined metrics. As a strawman method, just set a score for each
+  # participant based upon how many others voted for that person.
+
+  participants = snapshot.participants
+  pvotes = _build_votes_dict(participants, snapshot.game.voted)
+  for p in participants:
+    p.score = pvotes.get(p.plus_id, 0)
+    # accumulate game score and hangout_score with this round's results.
+    p.game_score += p.score
+    p.hangout_score += p.score
+  snapshot.mark_dirty(*participants)
+  return participants
+
+
+def _broadcast_scores(snapshot, participants, game_id, round_num):
+  """ broadcast the scores for the current round as well as the running game
+  score thus far for each participant.
+  """
+  pscores = {}
+  for p in participants:
+    pscores[p.plus_id] = (
+        {'score': p.score, 'game_score': p.game_score,
+         'hangout_score': p.hangout_score})
+  message = {'scores_info':
+             {'participant_scores': pscores, 'game_id': game_id,
+              'round': round_num}}
+  logging.info("scores message: %s", message)
+  snapshot.send(participants, message)
+  snapshot.spectate(message)
+
+
+def calculate_scores(snapshot, game_id=None, round_num=None, **kwargs):
+  """Calculate and broadcast the round's scores, then queue the setup of the
+  next round.
+  """
+  game = snapshot.game
+  participants = _calculate_scores(snapshot)
+  game.scored_round = round_num
+  # the round's selections, votes and scores are reset by the next stage,
+  # so keep a record of them.
+  record = models.RoundRecord.for_round(game, participants)
+  snapshot.mark_dirty(game, record)
+  # send out the score info on the channels.
+  _broadcast_scores(snapshot, participants, game_id, round_num)
+  tasks.defer(advance_round, snapshot.hangout_id, game_id, round_num)
+  tasks.defer(leaderboard.record_points, snapshot.hangout_id,
+              record.data['points'], record.key.id())
+  return True
+
+
+def next_round(snapshot, **kwargs):
+  """Start a new round.  This resets the card selection and vote fields.  If
+  we've had N rounds, this is a new game instead (which starts in the 'new'
+  state).
+  """
+  game = snapshot.game
+  if game.current_round >= (config.ROUNDS_PER_GAME - 1):
+    # if have reached the limit of rounds for a game,
+    # then start new game using the participants of the current game
     logging.info("starting new game.")
-    new_game = models.Hangout.start_new_game(self.hangout_id, participants)
-    logging.info("in start_new_game, got new game: %s", new_game)
-    return new_game
+    new_game = snapshot.start_new_game()
+    logging.info("in next_round, got new game: %s", new_game)
+  else:
+    # otherwise, start new round in the current game
+    logging.info("starting new round.")
+    # reset the inactive participants' selections and votes too, so that
+    # they don't carry over to a round they come back for.
+    participants = snapshot.participants + [
+        p for p in snapshot.inactive_participants()
+        if p.selected_card is not None or p.vote is not None]
+    game.start_new_round(participants)
+    snapshot.mark_dirty(game, *participants)
+    _set_round_timeout(snapshot)
+  return True
+
+
+def _broadcast_timeout(snapshot, step, auto_played, skipped):
+  game = snapshot.game
+  message = {'round_timeout':
+             {'game_id': game.key.id(), 'round': game.current_round,
+              'step': step, 'auto_played': auto_played, 'skipped': skipped,
+              'paused': game.is_paused}}
+  logging.info("round timeout msg: %s", message)
+  snapshot.send(snapshot.participants, message)
+  snapshot.spectate(message)
+
+
+def _pause_if_empty(snapshot):
+  """Pause the game if no players are left, rather than keep timing out its
+  rounds.  The next card selection restarts the clock.
+  """
+  game = snapshot.game
+  if not game.players:
+    logging.info("pausing game %s: no players left", game.key)
+    game.is_paused = True
+    game.clear_timeout()
+
+
+def set_playing(snapshot, game_id=None, playing=None, **kwargs):
+  """In any state, make players active in the game, or not (e.g. when they
+  leave, or their clients connect or disconnect).  playing is a dict of
+  plus_id to a boolean.  If game_id is given, nothing is changed unless it is
+  still the current game.  Removing players may complete the round's card
+  selection or voting, which the internal transitions then act on.
+  """
+  game = snapshot.game
+  if game_id is not None and game.key.id() != game_id:
+    logging.info("game %s is no longer current", game_id)
+    return False
+  for plus_id, is_playing in (playing or {}).iteritems():
+    participant = snapshot.get_participant(plus_id)
+    if not participant:
+      _report(kwargs.get('handler'),
+              "Could not retrieve indicated participant")
+      continue
+    if participant.playing != is_playing:
+      logging.info("participant %s playing: %s", plus_id, is_playing)
+      snapshot.set_playing(participant, is_playing)
+  return True
+
+
+def time_out_selection(snapshot, **kwargs):
+  """From the start_round state, once its timeout has passed, play a random
+  card from the hand of each player who hasn't selected one.  Players who
+  have no cards to play sit out the rest of the game (they can rejoin).
+  """
+  game = snapshot.game
+  auto_played = []
+  skipped = []
+  for plus_id in [p for p in game.players if p not in game.selected]:
+    participant = snapshot.get_participant(plus_id)
+    card_num = None
+    if participant and participant.cards:
+      card_num = random.choice(participant.cards)
+      if not _selected(participant.select_card(card_num)):
+        card_num = None
+    if card_num is not None:
+      game.record_selection(plus_id, card_num)
+      snapshot.mark_dirty(participant)
+      auto_played.append(plus_id)
+    else:
+      if participant:
+        snapshot.set_playing(participant, False)
+      else:
+        game.remove_player(plus_id)
+      skipped.append(plus_id)
+  _pause_if_empty(snapshot)
+  snapshot.mark_dirty(game)
+  _broadcast_timeout(snapshot, 'start_round', auto_played, skipped)
+  return True
 
-  def _calculate_scores(self, game):
-    # for all active participants, calculate everyone's scores, based on
-    # yet-to-be-defined metrics. As a strawman method, just set a score for each
-    # participant based upon how many others voted for that person.
 
-    participants = game.participants()
-    pvotes = self._build_votes_dict(participants)
-    for p in participants:
-      p.score = pvotes.get(p.plus_id, 0)
-      # accumulate game score and hangout_score with this round's results.
-      p.game_score += p.score
-      p.hangout_score += p.score
-    model.put_multi(participants)
-    return participants
-
-  def _build_votes_dict(self, participants):
-    """
-    Accumulate the votes for each participant from the other participants
-    for this round.
-    """
-    # more idiomatic way to do this?
-    pvotes = {}
-    for p in participants:
-      pid = p.vote.id()
-      pvcount = pvotes.get(pid, 0)
-      pvotes[pid] = pvcount + 1
-    logging.info("in _build_votes_dict, got pvotes: %s", pvotes)
-    return pvotes
-
-  def _broadcast_scores(self, participants, game_id, round_num):
-    """ broadcast the scores for the current round as well as the running game
-    score thus far for each participant.
-    """
-    pscores = {}
-    for p in participants:
-      pscores[p.plus_id] = (
-          {'score': p.score, 'game_score': p.game_score,
-           'hangout_score': p.hangout_score})
-    message = simplejson.dumps(
-        {'scores_info':
-         {'participant_scores': pscores, 'game_id': game_id,
-          'round': round_num}})
-    logging.info("scores message: %s", message)
-    for p in participants:
-      logging.info("sending channel msg to participant %s", p.plus_id)
-      channel.send_message(p.channel_id, message)
+def time_out_voting(snapshot, **kwargs):
+  """From the voting state, once its timeout has passed, count the players
+  who haven't voted as having abstained.
+  """
+  game = snapshot.game
+  skipped = [p for p in game.players if p not in game.voted]
+  for plus_id in skipped:
+    game.record_vote(plus_id)
+  _pause_if_empty(snapshot)
+  snapshot.mark_dirty(game)
+  _broadcast_timeout(snapshot, 'voting', [], skipped)
+  return True
 
 
 # ----------------------------------------
 
 
-class StartRoundGameState(GameState):
-  """ In the 'start_round' state, each participant selects an answer card
-  from their hand.
+class Transition(object):
+  """One entry of the state machine: in the given state, the given action
+  (None for an internal transition) is performed by effect, if guard (if
+  any) holds, leaving the game in next_state (if next_state is None, the
+  effect sets the state itself).
   """
 
-  def __init__(self, hangout_id):
-    GameState.__init__(self, hangout_id)
-    self.state_name = 'start_round'
-    self.next_states = ['start_round', 'voting']
-
-  def _make_transit(self, next_state, **kwargs):
-    if next_state == 'start_round':
-      return self._transit_to_start_round(**kwargs)
-    elif next_state == 'voting':
-      return self._transit_to_voting(**kwargs)
-    else:
-      return False
-
-  def _check_transit_conds(self, next_state, **kwargs):
-    game = models.Hangout.get_by_id(self.hangout_id).current_game.get()
-    if next_state == self.state_name:
-      return kwargs['action']  == 'select_card'
-    elif next_state == 'voting': # this internal state change will be
-        # explicitly requested
-      return self.all_cards_selected(game.key)
-    else:
-      return False
+  def __init__(self, state, action, guard, effect, next_state):
+    self.state = state
+    self.action = action
+    self.guard = guard
+    self.effect = effect
+    self.next_state = next_state
+
+  def __repr__(self):
+    return "Transition(%s --%s--> %s)" % (
+        self.state, self.action or '(internal)', self.next_state or '*')
+
+
+TRANSITIONS = [
+    Transition('new', 'start_game', enough_players, start_game,
+               'start_round'),
+    Transition('start_round', 'select_card', None, select_card,
+               'start_round'),
+    Transition('start_round', None, all_cards_selected, begin_voting,
+               'voting'),
+    Transition('start_round', 'timeout', round_timed_out, time_out_selection,
+               'start_round'),
+    # a user can vote more than once as long as the game is still in the
+    # 'voting' state; the last vote is retained.
+    Transition('voting', 'vote', None, vote, 'voting'),
+    Transition('voting', None, all_votesp, begin_scoring, 'scores'),
+    Transition('voting', 'timeout', round_timed_out, time_out_voting,
+               'voting'),
+    Transition('scores', 'score_round', round_not_scored, calculate_scores,
+               'scores'),
+    # leaves the game in 'start_round', or starts a new game in 'new'.
+    Transition('scores', 'advance_round', round_scored, next_round, None),
+] + [
+    # players can leave or come back at any time.
+    Transition(state, 'set_playing', None, set_playing, state)
+    for state in models.GAME_STATES
+]
+
+
+def compile_transitions(transitions):
+  """Build the (state, action) -> [Transition] dispatch map for the given
+  transitions, checking that they only use known game states.
+  """
+  dispatch = {}
+  for t in transitions:
+    for state in (t.state, t.next_state):
+      if state is not None and state not in models.GAME_STATES:
+        raise ValueError("unknown game state %s in %r" % (state, t))
+    dispatch.setdefault((t.state, t.action), []).append(t)
+  return dispatch
 
-  # transition condition to 'scores'
-  def all_cards_selected(self, game_key):
-    """returns a boolean, indicating whether all active game participants have
-    selected a card for this round.
-    """
-    participants = models.Participant.query(
-        models.Participant.playing == True,
-        models.Participant.selected_card == None,
-        ancestor=game_key).fetch()
-    logging.debug("participants who have not selected a card: %s", participants)
-    if participants:
-      return False
-    else:
-      return True
+_DISPATCH = compile_transitions(TRANSITIONS)
 
-  # performed if the action is 'select_card', as indicated in
-  # _check_transit_conds
-  def _transit_to_start_round(self, **kwargs):
-    """From the start_round state, transition to the start_round state.
-    """
-    logging.info("in _transit_to_start_round")
-    handler = kwargs['handler']
 
-    # Once placed, a vote will not be unset from within this 'voting' state,
-    # though it could be overridden with another vote from the same person
-    # before all votes are in (which is okay)
-    plus_id = kwargs['plus_id']
-    selected_card = kwargs['card_num']
+class GameEngine(object):
+  """Applies actions to a hangout's current game, using the transition
+  table.  Each call to run_action or run_actions is one transaction against
+  one GameSnapshot; the snapshot's broadcast is sent after the commit.
+  """
 
-    game = models.Hangout.get_by_id(self.hangout_id).current_game.get()
+  # the maximum number of internal transitions followed after an action
+  # (guards against a cycle in the table).
+  MAX_INTERNAL_TRANSITIONS = 10
+
+  def __init__(self, hangout_id):
+    self.hangout_id = hangout_id
+    self.snapshot = None  # the snapshot used by the last transaction
+    self.committed = False  # whether the last transaction committed
+    self.results = None  # the apply() results of the last transaction
+
+  def _fire(self, snapshot, transition, **kwargs):
+    res = transition.effect(snapshot, **kwargs)
+    logging.info("%r: %s", transition, res)
+    if res and transition.next_state:
+      snapshot.game.state = transition.next_state
+      snapshot.mark_dirty(snapshot.game)
+    return res
+
+  def _first_enabled(self, snapshot, action, **kwargs):
+    for t in _DISPATCH.get((snapshot.game.state, action), []):
+      # take the first transition whose guard holds
+      if t.guard is None or t.guard(snapshot, **kwargs):
+        return t
+    return None
+
+  def apply(self, snapshot, action, **kwargs):
+    """Apply the action, then any internal transitions it enables, to the
+    snapshot, without starting a transaction or writing anything back.
+    Returns an (action result, internal transitions result) tuple.  The action
+    result is True if the action was performed, False if there was an error,
+    and None if no transition applied.  The internal result is True if any
+    internal transitions were made, False if one failed, and None if there
+    were none.
+    """
+    handler = kwargs.get('handler')
+    game = snapshot.game
     if not game:
-      if handler:
-        handler.accumulate_response(
-            {'status': 'ERROR',
-             'message': "Game for hangout %s not found" % (self.hangout_id,)})
-      return False
-    else:
-      logging.debug("using game: %s", game)
-      # check game state.
-      # players can only select a card from the 'start_round' state.
-      if not game.state == self.state_name:
-        if handler:
-          handler.render_jsonp(
-              {'status' : 'ERROR',
-               'message': (
-                   "Can't vote now, wrong game state %s." % (game.state,))})
-        return False
-    participant_key = model.Key(models.Participant, plus_id, parent=game.key)
-    participant = participant_key.get()
-    if not participant:
-      if handler:
-        handler.accumulate_response(
-            {'status': 'ERROR',
-             'message': "Could not retrieve indicated participant"})
-      return False
-    sres = participant.select_card(selected_card)
-    participant.put()
-    if sres is None:  # need to check explicitly, b/c of card 0
-      if handler:
-        handler.accumulate_response(
-            {'status': 'ERROR',
-             'message': "could not select card %s from hand" % selected_card})
-      return False
-
-    # broadcast successful selection by player, but don't indicate the
-    # card selected.  (After all have selected, the shuffled set of
-    # selections will be broadcast)
-    self._cache_selection(
-        plus_id, selected_card, game.key.id(),
-        game.current_round)
-    message = simplejson.dumps({'player_selection': 
-               {'participant': plus_id,
-                'game_id': game.key.id(),
-                'round': game.current_round}})
-    logging.info("player selection channel msg: %s", message)
-    participants = game.participants()
-    for p in participants:
-      logging.info("sending channel msg to %s", p.plus_id)
-      channel.send_message(p.channel_id, message)
-    
-    return True
-
-  # performed if all participants have selected a card, as indicated in
-  # _check_transit_conds
-  def _transit_to_voting(self, **kwargs):
-    """From the start_round state, transition to the voting state.
+      _report(handler, "Game for hangout %s not found" % (self.hangout_id,))
+      return False, None
+    transition = self._first_enabled(snapshot, action, **kwargs)
+    if not transition:
+      if not _DISPATCH.get((game.state, action)):
+        _report(handler, "Can't %s now, wrong game state '%s'." % (
+            action, game.state))
+        return False, None
+      return None, None
+    res1 = self._fire(snapshot, transition, **kwargs)
+    res2 = None
+    for _ in range(self.MAX_INTERNAL_TRANSITIONS):
+      transition = self._first_enabled(snapshot, None, **kwargs)
+      if not transition:
+        break
+      res2 = self._fire(snapshot, transition, **kwargs)
+      if not res2:
+        break
+    return res1, res2
+
+  def run_actions(self, actions):
+    """Apply a batch of (action, kwargs) pairs, in order, in a single
+    transaction.  Returns the list of apply() results.
     """
-    logging.debug("in _transit_to_voting")
-    handler = kwargs['handler']
 
-    game = models.Hangout.get_by_id(self.hangout_id).current_game.get()
-    if not game:
-      if handler:
-        handler.accumulate_response(
-            {'status': 'ERROR',
-             'message': "Game for hangout %s not found" % (self.hangout_id,)})
-      return False
-    if game.state != self.state_name:
-      logging.info("game state %s not valid", game.state)
-      return False
-    game.state = 'voting'
-    game.put()
-    return True
-
-  def _cache_selection(self, plus_id, selected_card, game_id, curr_round):
-    """..."""
-
-    mkey = self._selections_key(game_id, curr_round)
-    selections = memcache.get(mkey)
-    if not selections:
-      selections = {}
-    selections[selected_card] = plus_id
-    memcache.set(mkey, selections)
+    def _tx():
+      snapshot = GameSnapshot.load(self.hangout_id)
+      results = [self.apply(snapshot, action, **kwargs)
+                 for action, kwargs in actions]
+      changed = snapshot.commit()
+      self.snapshot = snapshot
+      return results, changed
+    # Note: wrapping the entire transition, including its guards, in a
+    # transaction.  This takes advantage of the fact that currently
+    # everything we need to operate on is in the same entity group.
+    self.committed = False
+    results, changed = model.transaction(_tx)
+    self.results = results
+    self.committed = True
+    if changed:
+      gamestate.invalidate(self.hangout_id, self.snapshot.game.version)
+    self.snapshot.broadcast.send()
+    return results
+
+  def run_action(self, action, **kwargs):
+    """Apply the action, and any internal transitions it enables, in a single
+    transaction.  Returns the apply() result.
+    """
+    return self.run_actions([(action, kwargs)])[0]
+
+
+def score_round(hangout_id, game_id, round_num):
+  """Task: score the given round of the given game (pipeline stage 1)."""
+  return GameEngine(hangout_id).run_action(
+      'score_round', game_id=game_id, round_num=round_num)
+
+
+def advance_round(hangout_id, game_id, round_num):
+  """Task: set up the round or game following the given round (pipeline
+  stage 2).
+  """
+  return GameEngine(hangout_id).run_action(
+      'advance_round', game_id=game_id, round_num=round_num)
 
 
+def round_timeout(hangout_id, game_id, round_num):
+  """Task: time out the current step of the given round, if its deadline has
+  passed and the game hasn't moved on.
+  """
+  return GameEngine(hangout_id).run_action(
+      'timeout', game_id=game_id, round_num=round_num)
+
+
+def sweep_timeouts(now=None):
+  """Queue a round_timeout task for each game whose timeout has passed, as a
+  backstop for lost or failed deadline tasks.  Only the timeout index buckets
+  that have fully passed are queried, so this reads the expired games, not all
+  of them.  Returns the number of tasks queued.
+  """
+  now = now or datetime.datetime.now()
+  bucket = models.timeout_bucket_for(now)
+  # (the lower bound leaves out the games without a timeout, whose bucket is
+  # None, which sorts before any number.)
+  games = models.Game.query(models.Game.timeout_bucket >= 0,
+                            models.Game.timeout_bucket < bucket).fetch(
+                                config.TIMEOUT_SWEEP_BATCH)
+  for game in games:
+    tasks.defer(round_timeout, game.key.parent().id(), game.key.id(),
+                game.current_round)
+  logging.info("timeout sweep queued %s games", len(games))
+  return len(games)
+
+
+def _presence_task_name(hangout_id, slot):
+  return 'presence-%s-%d' % (hashlib.md5(hangout_id).hexdigest(), slot)
+
+
+def schedule_presence_update(hangout_id, now=None):
+  """Queue the update of the hangout's players from the presence of their
+  channels.  The notifications within each PRESENCE_BATCH_SECONDS slot are
+  coalesced: one (named) task per hangout and slot, run at the slot's end,
+  applies them all in one transaction.
+  """
+  now = now or datetime.datetime.now()
+  timestamp = calendar.timegm(now.timetuple())
+  slot = timestamp // config.PRESENCE_BATCH_SECONDS
+  slot_start = datetime.datetime.utcfromtimestamp(
+      slot * config.PRESENCE_BATCH_SECONDS)
+  countdown = (slot + 1) * config.PRESENCE_BATCH_SECONDS - timestamp
+  tasks.defer(update_presence, hangout_id, slot_start,
+              _name=_presence_task_name(hangout_id, slot),
+              _countdown=countdown)
+
+
+def update_presence(hangout_id, since):
+  """Task: make the players of the hangout's current game whose channel
+  connected or disconnected since the given time active, or not.
+  """
+  hangout = models.Hangout.get_by_id(hangout_id)
+  if not hangout or not hangout.current_game:
+    return None
+  # the channel sessions are in their own entity groups, so are read before
+  # the game's transaction.
+  participants = models.Participant.query(
+      ancestor=hangout.current_game).fetch()
+  participants = [p for p in participants if p.channel_id]
+  sessions = model.get_multi(
+      [model.Key(channels.ChannelSession, p.channel_id)
+       for p in participants])
+  playing = {}
+  for p, session in zip(participants, sessions):
+    if (session and session.last_seen and session.last_seen >= since and
+        session.connected != p.playing):
+      playing[p.plus_id] = session.connected
+  logging.info("presence changes for hangout %s: %s", hangout_id, playing)
+  if not playing:
+    return None
+  return GameEngine(hangout_id).run_action(
+      'set_playing', game_id=hangout.current_game.id(), playing=playing)
@@ -0,0 +1,89 @@
+"""Work deferred from a request to the task queue.
+
+Functions are queued with defer().  If called within a transaction, the task
+is transactional: it is only enqueued if the transaction commits.  For local
+runs and timing measurements, the task queue can be replaced by a
+LocalTaskQueue with set_queue().
+"""
+
+import logging
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+from ndb import model
+
+
+class DeferredQueue(object):
+  """Queues tasks with the deferred library."""
+
+  def add(self, func, *args, **kwargs):
+    try:
+      deferred.defer(func, _transactional=model.in_transaction(),
+                     *args, **kwargs)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      # a named task that has already been queued.
+      logging.debug("task %s already queued", kwargs.get('_name'))
+
+
+class LocalTaskQueue(object):
+  """A stand-in for the task queue, which holds the tasks until run() is
+  called, and records how long each one took.  Unlike real transactional
+  tasks, tasks added during a transaction attempt that is retried are not
+  discarded, so the deferred functions must be idempotent.  Task options
+  (e.g. _countdown) are ignored: the tasks run when run() is called.  As with
+  the task queue, a task with the same _name as an earlier one isn't added.
+  """
+
+  def __init__(self):
+    self.tasks = []
+    self.timings = []  # (function name, milliseconds) per task run
+    self.names = set()
+
+  def add(self, func, *args, **kwargs):
+    name = kwargs.get('_name')
+    if name:
+      if name in self.names:
+        return
+      self.names.add(name)
+    kwargs = dict((k, v) for k, v in kwargs.iteritems()
+                  if not k.startswith('_'))
+    self.tasks.append((func, args, kwargs))
+
+  def run(self):
+    """Run the queued tasks, including any that they queue, in order.
+    Returns the number of tasks run.
+    """
+    count = 0
+    while self.tasks:
+      func, args, kwargs = self.tasks.pop(0)
+      start = time.time()
+      func(*args, **kwargs)
+      self.timings.append((func.__name__, (time.time() - start) * 1000))
+      count += 1
+    return count
+
+
+_queue = DeferredQueue()
+
+
+def set_queue(queue):
+  """Replace the queue used by defer(), e.g. with a LocalTaskQueue.
+  Returns the previous queue.
+  """
+  global _queue
+  old_queue = _queue
+  _queue = queue
+  return old_queue
+
+
+def get_queue():
+  return _queue
+
+
+def defer(func, *args, **kwargs):
+  """Queue func(*args, **kwargs) to run as a task.  Keyword arguments
+  starting with an underscore are task options, as for deferred.defer.
+  """
+  logging.debug("deferring %s%s", func.__name__, args)
+  _queue.add(func, *args, **kwargs)
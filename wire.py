@@ -0,0 +1,90 @@
+"""Wire formats of the channel messages sent to players.
+
+Each player's client picks the format of its channel messages when it joins
+(with wire=<format>; see Participant.wire_format):
+
+ - 'json' (the default): the messages as they have always been sent.
+ - 'compact': json, with the keys shortened (see KEYS), and the plus ids of
+   the players replaced by their slots in the game (see Game.slots), so that
+   e.g. {"scores_info": {"participant_scores": {"<plus id>": {"score": 1,
+   ...}}}} becomes {"S": {"ps": {"0": {"s": 1, ...}}}}.  The slots are sent
+   in the join response, and in the game state (see gamestate.py).
+ - 'deflate': compact, and then, if the message is at least
+   WIRE_DEFLATE_MIN_BYTES long, raw-deflated and base64-encoded (channel
+   messages are strings), prefixed with '~' to tell it from plain compact
+   json.
+
+A message is encoded once per format for all the recipients of a broadcast.
+Spectators (see spectators.py) always get the json format.
+"""
+
+import base64
+import zlib
+
+try:
+  import json as simplejson
+except ImportError:
+  from django.utils import simplejson
+
+import config
+
+JSON = 'json'
+COMPACT = 'compact'
+DEFLATE = 'deflate'
+FORMATS = (JSON, COMPACT, DEFLATE)
+
+# the short keys of the compact formats.
+KEYS = {
+    'auto_played': 'a',
+    'card_text': 't',
+    'game_id': 'g',
+    'game_score': 'gs',
+    'hangout_score': 'hs',
+    'participant': 'p',
+    'participant_scores': 'ps',
+    'paused': 'z',
+    'player_selection': 'P',
+    'round': 'r',
+    'round_timeout': 'T',
+    'score': 's',
+    'scores_info': 'S',
+    'selected_cards': 'c',
+    'skipped': 'k',
+    'step': 'st',
+}
+
+# the keys whose values hold plus ids: a plus id, a list of them, or a dict
+# keyed by them.
+PLAYER_KEYS = frozenset(['auto_played', 'participant', 'participant_scores',
+                         'skipped'])
+
+
+def _compact(value, slots):
+  result = {}
+  for key, v in value.iteritems():
+    if key in PLAYER_KEYS:
+      if isinstance(v, dict):
+        v = dict((slots.get(k, k), v2) for k, v2 in v.iteritems())
+      elif isinstance(v, list):
+        v = [slots.get(p, p) for p in v]
+      else:
+        v = slots.get(v, v)
+    if isinstance(v, dict):
+      v = _compact(v, slots)
+    result[KEYS.get(key, key)] = v
+  return result
+
+
+def encode(message, wire_format, slots=()):
+  """Encode the message dict in the given format.  slots is the game's list
+  of player slots.  Returns the encoded string.
+  """
+  if wire_format not in (COMPACT, DEFLATE):
+    return simplejson.dumps(message)
+  slots = dict((plus_id, i) for i, plus_id in enumerate(slots))
+  encoded = simplejson.dumps(_compact(message, slots), separators=(',', ':'))
+  if wire_format == DEFLATE and len(encoded) >= config.WIRE_DEFLATE_MIN_BYTES:
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(encoded) + compressor.flush()
+    encoded = '~' + base64.b64encode(deflated)
+  return encoded